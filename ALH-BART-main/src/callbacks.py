@@ -61,6 +61,13 @@ class Seq2SeqLoggingCallback(pl.Callback):
             content = "\n".join(metrics["preds"])
             generations_file.open("w+").write(content)
 
+    def on_sanity_check_start(self, trainer, pl_module):
+        # PL 0.8.5's Trainer does not say when it is running the sanity check, so tell the module
+        pl_module.sanity_checking = True
+
+    def on_sanity_check_end(self, trainer, pl_module):
+        pl_module.sanity_checking = False
+
     @rank_zero_only
     def on_train_start(self, trainer, pl_module):
         try:
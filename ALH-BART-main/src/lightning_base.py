@@ -1,4 +1,5 @@
 import argparse
+import inspect
 import logging
 import os
 from pathlib import Path
@@ -33,6 +34,11 @@ from transformers.optimization import (
     get_polynomial_decay_schedule_with_warmup,
 )
 
+try:
+    from torch.optim._multi_tensor import AdamW as MultiTensorAdamW
+except ImportError:
+    MultiTensorAdamW = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +68,22 @@ arg_to_scheduler_choices = sorted(arg_to_scheduler.keys())
 arg_to_scheduler_metavar = "{" + ", ".join(arg_to_scheduler_choices) + "}"
 
 
+def fast_adamw(params, **kwargs):
+    """AdamW with a fused (torch>=2.0, CUDA params only) or multi-tensor (torch>=1.7) update, falling back to
+    transformers.AdamW.
+
+    ``params`` is a list of param group dicts. The updates are equivalent up to where ``eps`` is applied:
+    transformers.AdamW adds it to the denominator before bias correction, torch.optim.AdamW after."""
+    kwargs.setdefault("weight_decay", 0.0)  # transformers.AdamW default, torch.optim.AdamW uses 1e-2
+    # fused AdamW rejects CPU tensors, e.g. a --gpus 0 run on a GPU host
+    on_cuda = all(p.is_cuda for group in params for p in group["params"])
+    if "fused" in inspect.signature(torch.optim.AdamW).parameters and on_cuda:
+        return torch.optim.AdamW(params, fused=True, **kwargs)
+    if MultiTensorAdamW is not None:
+        return MultiTensorAdamW(params, **kwargs)
+    return AdamW(params, **kwargs)
+
+
 class BaseTransformer(pl.LightningModule):
     def __init__(
         self,
@@ -126,6 +148,9 @@ class BaseTransformer(pl.LightningModule):
         self.config.use_graph = hparams.use_graph
 
         self.config.no_rezero = hparams.no_rezero
+        self.config.use_torch_compile = getattr(hparams, "compile_layers", False)
+        self.config.gat_bf16 = getattr(hparams, "gat_bf16", False)
+        self.config.fused_lm_loss = getattr(hparams, "fused_lm_loss", False)
 
         #print(hparams.seed)
         # pl.seed_everything(hparams.seed)
@@ -291,7 +316,7 @@ class BaseTransformer(pl.LightningModule):
                 
 
             else:
-                optimizer = AdamW(
+                optimizer = fast_adamw(
                     optimizer_grouped_parameters, eps=self.hparams.adam_epsilon
                 )
                 
@@ -421,13 +446,13 @@ class BaseTransformer(pl.LightningModule):
 
             else:
                 #if not self.hparams.freeze:
-                optimizer = AdamW(
+                optimizer = fast_adamw(
                     optimizer_grouped_parameters, lr=self.hparams.learning_rate, eps=self.hparams.adam_epsilon
                 )
                 #else:
                 #    optimizer = None
 
-                optimizer2 = AdamW(
+                optimizer2 = fast_adamw(
                     optimizer_grouped_parameters_new, lr=lr_new, eps=self.hparams.adam_epsilon
                 )
 
@@ -466,7 +491,7 @@ class BaseTransformer(pl.LightningModule):
                 )
 
             else:
-                optimizer = AdamW(
+                optimizer = fast_adamw(
                     optimizer_grouped_parameters, lr=self.hparams.learning_rate, eps=self.hparams.adam_epsilon
                 )
             self.opt = optimizer
@@ -484,6 +509,9 @@ class BaseTransformer(pl.LightningModule):
     @property
     def total_steps(self) -> int:
         """The number of total training steps that will be run. Used for lr scheduler purposes."""
+        if self.train_loader.batch_size is None:
+            # token-budgeted batch samplers: count their (per-replica) batches instead of assuming train_batch_size
+            return (len(self.train_loader) / self.hparams.accumulate_grad_batches) * self.hparams.max_epochs
         num_devices = max(1, self.hparams.gpus)  # TODO: consider num_tpu_cores
         effective_batch_size = self.hparams.train_batch_size * self.hparams.accumulate_grad_batches * num_devices
         dataset_size = len(self.train_loader.dataset)
@@ -689,6 +717,8 @@ def generic_train(
         train_params["distributed_backend"] = "ddp"
 
     train_params["accumulate_grad_batches"] = args.accumulate_grad_batches
+    # the batches repeat a small set of shapes, so let cudnn autotune its kernels for them
+    train_params["benchmark"] = True
 
     trainer = pl.Trainer.from_argparse_args(
         args,
@@ -0,0 +1,110 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+
+from transformers import BartTokenizer
+from utils import BucketBatchSampler, DistributedBucketBatchSampler, Seq2SeqDataset, pickle_save, utf8_escape
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "plain ascii",
+        "it's",
+        'say "x"',
+        "it's \"x\"",
+        "back\\slash\ttab\nnewline\x00\x7f",
+        "café 中文 \U0001f600",
+        "it's café \"x\" \\ ’",
+    ],
+)
+def test_utf8_escape_matches_bytes_repr(text):
+    assert utf8_escape(text) == str(text.encode("utf-8"))[2:-1]
+
+
+def _bucket_lengths(n=500, seed=0):
+    return np.random.RandomState(seed).randint(4, 140, size=n)
+
+
+def test_bucket_sampler_covers_every_index_within_budget():
+    lengths, max_tokens = _bucket_lengths(), 512
+    sampler = BucketBatchSampler(lengths, max_tokens, shuffle=True)
+    for _ in range(3):
+        n_batches = len(sampler)
+        batches = list(sampler)
+        assert len(batches) == n_batches
+        assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+        assert all(lengths[b].max() * len(b) <= max_tokens for b in batches)
+
+
+def test_bucket_sampler_batch_count_is_fixed_across_epochs():
+    lengths = _bucket_lengths()
+    sampler = BucketBatchSampler(lengths, 512, shuffle=True)
+    expected = len(sampler)
+    for _ in range(3):
+        assert len(list(sampler)) == expected
+    assert len(BucketBatchSampler(lengths, 512, shuffle=False)) == expected
+
+
+def test_bucket_sampler_unshuffled_is_deterministic():
+    lengths = _bucket_lengths()
+    first = list(BucketBatchSampler(lengths, 512, shuffle=False))
+    second = list(BucketBatchSampler(lengths, 512, shuffle=False))
+    assert first == second
+
+
+def test_distributed_bucket_sampler_replicas_agree_and_cover():
+    lengths, num_replicas = _bucket_lengths(), 3
+    samplers = [DistributedBucketBatchSampler(lengths, 512, num_replicas=num_replicas, rank=r) for r in range(num_replicas)]
+    for epoch in range(2):
+        per_rank = [list(s) for s in samplers]
+        assert len({len(b) for b in per_rank}) == 1
+        assert all(len(b) == len(s) for b, s in zip(per_rank, samplers))
+        seen = {i for batches in per_rank for b in batches for i in b}
+        assert seen == set(range(len(lengths)))
+        # the same epoch reproduces the same batches on every replica
+        for rank, s in enumerate(samplers):
+            s.set_epoch(epoch)
+            assert list(s) == per_rank[rank]
+
+
+def _tiny_bart_tokenizer(tmp_path):
+    # Adapted from Sennrich et al. 2015 and https://github.com/rsennrich/subword-nmt
+    vocab = ["<s>", "<pad>", "</s>", "<unk>", "l", "o", "w", "e", "r", "s", "t", "i", "d", "n"]
+    vocab += ["\u0120", "\u0120l", "\u0120n", "\u0120lo", "\u0120low", "er", "\u0120lowest", "\u0120newer", "<mask>"]
+    merges = ["#version: 0.2", "\u0120 l", "\u0120l o", "\u0120lo w", "e r", ""]
+    vocab_file, merges_file = tmp_path / "vocab.json", tmp_path / "merges.txt"
+    vocab_file.write_text(json.dumps(dict(zip(vocab, range(len(vocab))))), encoding="utf-8")
+    merges_file.write_text("\n".join(merges), encoding="utf-8")
+    return BartTokenizer(str(vocab_file), str(merges_file))
+
+
+def test_token_cache_round_trip(tmp_path):
+    tokenizer = _tiny_bart_tokenizer(tmp_path)
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    (data_dir / "train.source").write_text("lower newer\nlow\nnewer lowest low lower\nwider low\n")
+    (data_dir / "train.target").write_text("low\nnewer lower\nlowest\nlow low low\n")
+    # graph sizes differ between examples, but match within each batch below
+    sizes = [3, 3, 5, 5]
+    pickle_save([np.arange(n * n).reshape(n, n) % 18 for n in sizes], data_dir / "train_relation_adj.pkl")
+    kwargs = dict(tokenizer=tokenizer, data_dir=data_dir, max_source_length=6, max_target_length=4)
+
+    uncached = Seq2SeqDataset(**kwargs)
+    uncached.write_token_cache()
+    cached = Seq2SeqDataset(token_cache=True, **kwargs)
+    assert cached.src_ids is not None and cached.adj_values is not None
+
+    for indices in ([0, 1], [2, 3]):
+        expected = uncached.collate_fn([uncached[i] for i in indices])
+        actual = cached.collate_fn([cached[i] for i in indices])
+        assert expected.keys() == actual.keys()
+        for k, v in expected.items():
+            if torch.is_tensor(v):
+                assert v.dtype == actual[k].dtype, k
+                assert torch.equal(v, actual[k]), k
+            else:
+                assert v == actual[k], k
@@ -1,21 +1,22 @@
 import argparse
 import glob
 import logging
+import multiprocessing
 import os
 import sys
 import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Tuple
-
-import torch
-import numpy as np
-import random
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import DataLoader
+from pytorch_lightning.overrides.data_parallel import LightningDistributedDataParallel
+from pytorch_lightning.utilities import rank_zero_only
+from torch.utils.data import DataLoader, DistributedSampler
 
 from callbacks import Seq2SeqLoggingCallback, get_checkpoint_callback, get_early_stopping_callback
 from transformers import MBartTokenizer, T5ForConditionalGeneration, BartTokenizer
@@ -29,10 +30,11 @@ from utils import (
     calculate_rouge,
     flatten_list,
     freeze_params,
-    label_smoothed_nll_loss,
-    lmap,
+    inference_mode,
+    label_smoothed_cross_entropy,
     pickle_save,
     use_task_specific_params,
+    utf8_escape,
 )
 
 # need the parent dir module
@@ -42,6 +44,32 @@ from lightning_base import BaseTransformer, add_generic_args, generic_train  # n
 logger = logging.getLogger(__name__)
 
 
+class _SkipBackwardSync:
+    """Stands in for the DDP reducer while a forward runs whose backward must not all-reduce."""
+
+    @staticmethod
+    def prepare_for_backward(*args):
+        pass
+
+
+class AccumulatingDistributedDataParallel(LightningDistributedDataParallel):
+    """LightningDistributedDataParallel that honors ``require_backward_grad_sync`` like torch's ``DDP.no_sync()``.
+
+    PL 0.8.5's forward always calls ``reducer.prepare_for_backward``, which arms the gradient all-reduce hooks. While
+    sync is off it gets a no-op reducer instead, so that backward only accumulates the local gradients.
+    """
+
+    def forward(self, *inputs, **kwargs):
+        if self.require_backward_grad_sync:
+            return super().forward(*inputs, **kwargs)
+        reducer = self.reducer
+        self.reducer = _SkipBackwardSync
+        try:
+            return super().forward(*inputs, **kwargs)
+        finally:
+            self.reducer = reducer
+
+
 
 class SummarizationModule(BaseTransformer):
     mode = "summarization"
@@ -50,7 +78,8 @@ class SummarizationModule(BaseTransformer):
     default_val_metric = "rouge-2"
 
     def __init__(self, hparams, **kwargs):
-        if hparams.sortish_sampler and hparams.gpus > 1:
+        if hparams.max_tokens_per_batch is None and hparams.gpus > 1:
+            # get_dataloader gives every loader its own distributed (sortish, bucketed or plain) sampler
             hparams.replace_sampler_ddp = False
         elif hparams.max_tokens_per_batch is not None:
             if hparams.gpus > 1:
@@ -64,11 +93,11 @@ class SummarizationModule(BaseTransformer):
         #save_git_info(self.hparams.output_dir)
         self.metrics_save_path = Path(self.output_dir) / "metrics.json"
         self.hparams_save_path = Path(self.output_dir) / "hparams.pkl"
-        pickle_save(self.hparams, self.hparams_save_path)
         self.step_count = 0
         self.metrics = defaultdict(list)
         self.model_type = self.config.model_type
         self.vocab_size = self.config.tgt_vocab_size if self.model_type == "fsmt" else self.config.vocab_size
+        self.ce_loss_fct = torch.nn.CrossEntropyLoss(ignore_index=self.tokenizer.pad_token_id)
 
         self.dataset_kwargs: dict = dict(
             data_dir=self.hparams.data_dir,
@@ -119,6 +148,49 @@ class SummarizationModule(BaseTransformer):
         else:
             self.eval_max_length = self.model.config.max_length
         self.val_metric = self.default_val_metric if self.hparams.val_metric is None else self.hparams.val_metric
+        # resolved once here so that _step does not repeat the lookups on every micro-batch
+        self.pad_token_id = self.tokenizer.pad_token_id
+        self.label_smoothing = self.hparams.label_smoothing
+        self.action_graph = self.hparams.action_graph
+        if isinstance(self.model, T5ForConditionalGeneration):
+            self.shift_right = self.model._shift_right
+        else:
+            self.shift_right = partial(shift_tokens_right, pad_token_id=self.pad_token_id)
+        # these flags are fixed for the whole run, so build the kwargs once instead of on every step
+        self.graph_kwargs = dict(
+            discourse_graph=self.hparams.discourse_graph,
+            segmented_encoder=self.hparams.segmented_encoder,
+            relation=self.hparams.relation,
+            sent_encoder=self.hparams.sent_encoder,
+        )
+        self.eval_metric_sums = defaultdict(float)
+        self.eval_batches = 0
+        self.rouge_pool = None  # started on the first eval batch, see --rouge_workers
+        self.sanity_checking = False  # set by Seq2SeqLoggingCallback
+        self.rouge_futures = []
+        self.copy_stream = None  # created on first use, once the CUDA device is known
+        self.compiled_forward = None
+        if self.hparams.compile:
+            if hasattr(torch, "compile"):
+                # compile the bound call rather than wrapping the module, so checkpoint keys stay unprefixed;
+                # the graph flags are fixed for a run, so dynamo specializes on them instead of breaking the graph
+                self.compiled_forward = torch.compile(self.model.__call__, mode=self.hparams.compile_mode, dynamic=False)
+            else:
+                logger.warning("--compile needs torch>=2.0, running the model eagerly")
+        if self.hparams.compile_layers and not hasattr(torch, "compile"):
+            logger.warning("--compile_layers needs torch>=2.0, running the layers eagerly")
+        if self.hparams.fused_lm_loss and self.hparams.label_smoothing > 0:
+            logger.warning("--fused_lm_loss does not support --label_smoothing, computing the loss from full logits")
+        if self.hparams.gat_bf16 and not hasattr(torch, "autocast"):
+            logger.warning("--gat_bf16 needs torch>=1.10, running the graph attention in fp32")
+        self.quantized_for_test = False
+        if (self.hparams.quantize_ffn or self.hparams.quantize_lm_head) and self.hparams.gpus > 0:
+            logger.warning("--quantize_ffn/--quantize_lm_head only have CPU kernels, testing in full precision")
+
+    @rank_zero_only
+    def on_train_start(self):
+        # every DDP process builds the module, only one of them needs to write
+        pickle_save(self.hparams, self.hparams_save_path)
 
     def freeze_embeds(self):
         """Freeze token embeddings and positional embeddings for bart, just token embeddings for t5."""
@@ -137,29 +209,30 @@ class SummarizationModule(BaseTransformer):
                 freeze_params(d.embed_tokens)
 
     def forward(self, input_ids, **kwargs):
+        if self.compiled_forward is not None:
+            return self.compiled_forward(input_ids, **kwargs)
         return self.model(input_ids, **kwargs)
 
     def ids_to_clean_text(self, generated_ids: List[int]):
         gen_text = self.tokenizer.batch_decode(
             generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
         )
-        gen_text = [str(i.encode('utf-8'))[2:-1] for i in gen_text]
-        #print(gen_text)
-        return lmap(str.strip, gen_text)
+        return [utf8_escape(s).strip() for s in gen_text]
+
+    @staticmethod
+    def _src_mask(batch: dict) -> Optional[torch.Tensor]:
+        """The source attention mask, or None when the collator saw no padding so the model can skip masking."""
+        return batch["attention_mask"] if batch.get("src_has_padding", True) else None
 
-    def _step(self, batch: dict) -> Tuple:
+    def _step(self, batch: dict, encoder_outputs: Optional[Tuple] = None) -> Tuple:
         # print("here", batch)
-        pad_token_id = self.tokenizer.pad_token_id
-        src_ids, src_mask = batch["input_ids"], batch["attention_mask"]
+        src_ids, src_mask = batch["input_ids"], self._src_mask(batch)
         tgt_ids = batch["labels"]
-        if isinstance(self.model, T5ForConditionalGeneration):
-            decoder_input_ids = self.model._shift_right(tgt_ids)
-        else:
-            decoder_input_ids = shift_tokens_right(tgt_ids, pad_token_id)
+        decoder_input_ids = self.shift_right(tgt_ids)
 
         adj = batch["adj"]
 
-        if self.hparams.action_graph:
+        if self.action_graph:
             action_adj = batch["action_adj"]
             actions = batch['actions']
             actions_mask = batch['actions_mask']
@@ -170,52 +243,97 @@ class SummarizationModule(BaseTransformer):
 
         #print(self.hparams.discourse_graph)
         
-        outputs = self(src_ids, attention_mask=src_mask, decoder_input_ids=decoder_input_ids, use_cache=False, discourse_graph = self.hparams.discourse_graph, adj = adj, segmented_encoder = self.hparams.segmented_encoder, relation = self.hparams.relation, action_adj = action_adj, actions = actions, actions_mask = actions_mask, sent_encoder=self.hparams.sent_encoder)
+        if self.hparams.fused_lm_loss and self.label_smoothing == 0:
+            # the model computes the loss chunk by chunk without building the logits; pad is ignored as -100
+            labels = tgt_ids.masked_fill(tgt_ids.eq(self.pad_token_id), -100)
+            outputs = self(src_ids, attention_mask=src_mask, decoder_input_ids=decoder_input_ids, encoder_outputs=encoder_outputs, use_cache=False, adj = adj, action_adj = action_adj, actions = actions, actions_mask = actions_mask, labels=labels, **self.graph_kwargs)
+            return (outputs[0],)
+
+        outputs = self(src_ids, attention_mask=src_mask, decoder_input_ids=decoder_input_ids, encoder_outputs=encoder_outputs, use_cache=False, adj = adj, action_adj = action_adj, actions = actions, actions_mask = actions_mask, **self.graph_kwargs)
         
         #print(outputs)
 
         lm_logits = outputs[0]
-        if self.hparams.label_smoothing == 0:
+        if self.label_smoothing == 0:
             # Same behavior as modeling_bart.py, besides ignoring pad_token_id
-            ce_loss_fct = torch.nn.CrossEntropyLoss(ignore_index=pad_token_id)
-
             assert lm_logits.shape[-1] == self.vocab_size
-            loss = ce_loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), tgt_ids.view(-1))
+            loss = self.ce_loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), tgt_ids.view(-1))
         else:
-            lprobs = torch.nn.functional.log_softmax(lm_logits, dim=-1)
-            loss, nll_loss = label_smoothed_nll_loss(
-                lprobs, tgt_ids, self.hparams.label_smoothing, ignore_index=pad_token_id
+            loss = label_smoothed_cross_entropy(
+                lm_logits, tgt_ids, self.label_smoothing, ignore_index=self.pad_token_id
             )
-        
+
         return (loss,)
 
     @property
     def pad(self) -> int:
-        return self.tokenizer.pad_token_id
-
+        return self.pad_token_id
+
+
+    def transfer_batch_to_device(self, batch, device):
+        if not isinstance(batch, dict) or device is None or torch.device(device).type != "cuda":
+            return super().transfer_batch_to_device(batch, device)
+        # copy on a side stream so the upload does not queue behind the kernels still running on the compute stream
+        if self.copy_stream is None:
+            self.copy_stream = torch.cuda.Stream(device)
+        compute_stream = torch.cuda.current_stream(device)
+        with torch.cuda.stream(self.copy_stream):
+            batch = {k: v.to(device, non_blocking=True) if torch.is_tensor(v) else v for k, v in batch.items()}
+        compute_stream.wait_stream(self.copy_stream)
+        for v in batch.values():
+            if torch.is_tensor(v):
+                # the copies were allocated on copy_stream, keep the allocator from reusing them too early
+                v.record_stream(compute_stream)
+        return batch
+
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx):
+        # dropping the grads is cheaper than memsetting them, and the next backward simply assigns
+        optimizer.zero_grad(set_to_none=True)
+
+    def configure_ddp(self, model, device_ids):
+        return AccumulatingDistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
+
+    def on_batch_start(self, batch):
+        # only the micro-batch that ends in optimizer.step all-reduces, the others just accumulate local gradients
+        model = self.trainer.model
+        if isinstance(model, AccumulatingDistributedDataParallel):
+            batch_idx = self.trainer.batch_idx
+            model.require_backward_grad_sync = (batch_idx + 1) % self.trainer.accumulate_grad_batches == 0 or (
+                batch_idx + 1
+            ) == self.trainer.num_training_batches
 
     def training_step(self, batch, batch_idx, optimizer_idx = None) -> Dict:
         loss_tensors = self._step(batch)
 
         logs = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
-        # tokens per batch
-        logs["tpb"] = batch["input_ids"].ne(self.pad).sum() + batch["labels"].ne(self.pad).sum()
         logs["bs"] = batch["input_ids"].shape[0]
-        logs["src_pad_tok"] = batch["input_ids"].eq(self.pad).sum()
-        logs["src_pad_frac"] = batch["input_ids"].eq(self.pad).float().mean()
+        # the padding stats are only worth their kernels on steps that Lightning actually logs
+        if batch_idx % self.trainer.row_log_interval == 0:
+            src_ids, tgt_ids = batch["input_ids"], batch["labels"]
+            src_pad_tok = src_ids.eq(self.pad).sum()
+            # tokens per batch
+            logs["tpb"] = src_ids.numel() + tgt_ids.numel() - src_pad_tok - tgt_ids.eq(self.pad).sum()
+            logs["src_pad_tok"] = src_pad_tok
+            logs["src_pad_frac"] = src_pad_tok.float() / src_ids.numel()
         # TODO(SS): make a wandb summary metric for this
         return {"loss": loss_tensors[0], "log": logs}
 
     def validation_step(self, batch, batch_idx) -> Dict:
-        return self._generative_step(batch)
+        return self._generative_step(batch, batch_idx)
 
     def validation_epoch_end(self, outputs, prefix="val") -> Dict:
         self.step_count += 1
-        losses = {k: torch.stack([x[k] for x in outputs]).mean() for k in self.loss_names}
+        for future in self.rouge_futures:
+            self.add_eval_metrics(future.result())
+        self.rouge_futures = []
+        # batches that skipped the loss forward (see --val_loss_every) carry no loss entry
+        losses = {k: torch.stack([x[k] for x in outputs if k in x]).mean() for k in self.loss_names}
         loss = losses["loss"]
         generative_metrics = {
-            k: np.array([x[k] for x in outputs]).mean() for k in self.metric_names + ["gen_time", "gen_len"]
+            k: self.eval_metric_sums[k] / self.eval_batches for k in self.metric_names + ["gen_time", "gen_len"]
         }
+        self.eval_metric_sums.clear()
+        self.eval_batches = 0
         metric_val = (
             generative_metrics[self.val_metric] if self.val_metric in generative_metrics else losses[self.val_metric]
         )
@@ -226,6 +344,10 @@ class SummarizationModule(BaseTransformer):
         all_metrics["step_count"] = self.step_count
         self.metrics[prefix].append(all_metrics)  # callback writes this to self.metrics_save_path
         preds = flatten_list([x["preds"] for x in outputs])
+        if "ids" in outputs[0]:
+            # eval loaders are length-sorted, put generations back in file order
+            ids = flatten_list([x["ids"] for x in outputs])
+            preds = [preds[i] for i in np.argsort(ids, kind="stable")]
         return {
             "log": all_metrics,
             "preds": preds,
@@ -233,10 +355,17 @@ class SummarizationModule(BaseTransformer):
             f"{prefix}_{self.val_metric}": metric_tensor,
         }
 
-    def calc_generative_metrics(self, preds, target) -> Dict:
+    @staticmethod
+    def calc_generative_metrics(preds, target) -> Dict:
+        # static, so --rouge_workers can send it to the pool without pickling the module; override it as one too
         return calculate_rouge(preds, target)
 
-    def _generative_step(self, batch: dict) -> dict:
+    def add_eval_metrics(self, metrics: Dict):
+        # scalar metrics are summed on the module instead of being carried through outputs to the epoch end
+        for k, v in metrics.items():
+            self.eval_metric_sums[k] += v
+
+    def _generative_step(self, batch: dict, batch_idx: int = 0) -> dict:
         t0 = time.time()
 
         # parser.add_argument('--eval_max_gen_length', type=int, default=None, help='never generate more than n tokens')
@@ -244,54 +373,86 @@ class SummarizationModule(BaseTransformer):
         #print(self.hparams.discourse_graph)
         #print('generate')
        
+        action_kwargs = {}
         if self.hparams.action_graph:
-            generated_ids = self.model.generate(
+            action_kwargs = dict(
+                action_adj=batch["action_adj"],
+                actions=batch["actions"],
+                actions_mask=batch["actions_mask"],
+                action_graph=self.hparams.action_graph,
+            )
+        # inference_mode skips the version-counter/view tracking that no_grad still does; with --fp16 the
+        # decoder matmuls also run in half precision while the fp32 weights stay untouched for training
+        with inference_mode(), torch.cuda.amp.autocast(enabled=self.hparams.fp16):
+            # run the encoder once and share it between generate() and the loss forward below
+            encoder_outputs = self.model.get_encoder()(
                 batch["input_ids"],
-                attention_mask=batch["attention_mask"],
-                use_cache=True,
-                decoder_start_token_id=self.decoder_start_token_id,
-                num_beams=self.eval_beams,
-                max_length=self.eval_max_length,
-                adj = batch["adj"],
-                discourse_graph = self.hparams.discourse_graph,
-                segmented_encoder = self.hparams.segmented_encoder,
-                relation = self.hparams.relation,
-                action_adj = batch["action_adj"],
-                actions = batch["actions"],
-                actions_mask = batch["actions_mask"],
-                action_graph = self.hparams.action_graph,
-                sent_encoder = self.hparams.sent_encoder,
+                attention_mask=self._src_mask(batch),
+                return_dict=True,
+                segmented_encoder=self.hparams.segmented_encoder,
             )
-        else:
+            # generate() swaps in beam-expanded states, keep a handle on the unexpanded ones
+            encoder_states = encoder_outputs.to_tuple()
             generated_ids = self.model.generate(
                 batch["input_ids"],
                 attention_mask=batch["attention_mask"],
                 use_cache=True,
                 decoder_start_token_id=self.decoder_start_token_id,
+                pad_token_id=self.pad_token_id,
                 num_beams=self.eval_beams,
                 max_length=self.eval_max_length,
-                adj = batch["adj"],
-                discourse_graph = self.hparams.discourse_graph,
-                segmented_encoder = self.hparams.segmented_encoder,
-                relation = self.hparams.relation,
-                sent_encoder=self.hparams.sent_encoder,
+                adj=batch["adj"],
+                encoder_outputs=encoder_outputs,
+                **self.graph_kwargs,
+                **action_kwargs,
             )
 
-        
-        #print('end generate')
-        
         gen_time = (time.time() - t0) / batch["input_ids"].shape[0]
         preds: List[str] = self.ids_to_clean_text(generated_ids)
         target: List[str] = self.ids_to_clean_text(batch["labels"])
-        loss_tensors = self._step(batch)
-        base_metrics = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
-        rouge: Dict = self.calc_generative_metrics(preds, target)
-        summ_len = np.mean(lmap(len, generated_ids))
-        base_metrics.update(gen_time=gen_time, gen_len=summ_len, preds=preds, target=target, **rouge)
+        base_metrics = {"preds": preds}
+        # the teacher-forced loss reuses the encoder states from generate; --val_loss_every > 1 subsamples it
+        if batch_idx % self.hparams.val_loss_every == 0:
+            with inference_mode(), torch.cuda.amp.autocast(enabled=self.hparams.fp16):
+                loss_tensors = self._step(batch, encoder_outputs=encoder_states)
+            base_metrics.update(zip(self.loss_names, loss_tensors))
+        if self.hparams.rouge_workers > 0 and not self.sanity_checking:
+            # score in worker processes while the GPU moves on to the next batch, collected at epoch end
+            if self.rouge_pool is None:
+                # spawn, not fork: a forked child would inherit the CUDA context and the dataloader threads
+                self.rouge_pool = ProcessPoolExecutor(
+                    max_workers=self.hparams.rouge_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            self.rouge_futures.append(self.rouge_pool.submit(self.calc_generative_metrics, preds, target))
+        else:
+            self.add_eval_metrics(self.calc_generative_metrics(preds, target))
+        # every row of generated_ids is padded to the same width, so this is what mean(len(row)) computed
+        summ_len = generated_ids.shape[1]
+        self.add_eval_metrics(dict(gen_time=gen_time, gen_len=summ_len))
+        self.eval_batches += 1
+        if "ids" in batch:
+            base_metrics["ids"] = batch["ids"].tolist()
         return base_metrics
 
+    def teardown(self, stage):
+        if self.rouge_pool is not None:
+            self.rouge_pool.shutdown()
+            self.rouge_pool = None
+
+    def quantize_for_test(self):
+        """int8 CPU inference for the test run. Done on the first test batch, i.e. after the best checkpoint is loaded."""
+        self.quantized_for_test = True
+        if self.hparams.gpus > 0:
+            return
+        if self.hparams.quantize_ffn:
+            self.model.quantize_ffn_()
+        if self.hparams.quantize_lm_head:
+            self.model.quantize_lm_head_()
+
     def test_step(self, batch, batch_idx):
-        return self._generative_step(batch)
+        if not self.quantized_for_test:
+            self.quantize_for_test()
+        return self._generative_step(batch, batch_idx)
 
     def test_epoch_end(self, outputs):
         return self.validation_epoch_end(outputs, prefix="test")
@@ -307,12 +468,24 @@ class SummarizationModule(BaseTransformer):
             action_graph = self.hparams.action_graph,
             random_graph = self.hparams.random_graph,
             use_graph = self.hparams.use_graph,
+            token_cache = self.hparams.token_cache,
             **self.dataset_kwargs,
         )
         return dataset
 
+    def prepare_data(self):
+        if not self.hparams.token_cache:
+            return
+        for type_path in ["train", "val", "test"]:
+            if Path(self.hparams.data_dir).joinpath(type_path + ".source").exists():
+                self.get_dataset(type_path).write_token_cache()
+
     def get_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False) -> DataLoader:
         dataset = self.get_dataset(type_path)
+        loader_kwargs = dict(num_workers=self.num_workers, pin_memory=True)
+        if self.num_workers > 0:
+            # keep workers (and their linecache/pickled graphs) alive across epochs and queue more batches ahead
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
 
         if self.hparams.sortish_sampler and type_path != "test":
             sampler = dataset.make_sortish_sampler(batch_size, distributed=self.hparams.gpus > 1)
@@ -321,8 +494,8 @@ class SummarizationModule(BaseTransformer):
                 batch_size=batch_size,
                 collate_fn=dataset.collate_fn,
                 shuffle=False,
-                num_workers=self.num_workers,
                 sampler=sampler,
+                **loader_kwargs,
             )
 
         elif self.hparams.max_tokens_per_batch is not None and type_path != "test":
@@ -334,17 +507,33 @@ class SummarizationModule(BaseTransformer):
                 batch_sampler=batch_sampler,
                 collate_fn=dataset.collate_fn,
                 # shuffle=False,
-                num_workers=self.num_workers,
                 # batch_size=None,
+                **loader_kwargs,
+            )
+        elif self.hparams.bucket_sampler and type_path != "test":
+            # same worst-case memory as a fixed batch of full-length examples, but short examples are packed tighter
+            max_tokens = batch_size * (dataset.max_source_length + dataset.max_target_length)
+            batch_sampler = dataset.make_bucket_sampler(max_tokens, distributed=self.hparams.gpus > 1, shuffle=shuffle)
+            return DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=dataset.collate_fn,
+                **loader_kwargs,
             )
         else:
+            distributed = self.hparams.gpus > 1
+            if shuffle:
+                sampler = DistributedSampler(dataset) if distributed else None
+            else:
+                # eval batches go longest-first in a fixed order so each batch pads (and decodes) to a similar length
+                sampler = dataset.make_sortish_sampler(batch_size, distributed=distributed, shuffle=False)
             return DataLoader(
                 dataset,
                 batch_size=batch_size,
                 collate_fn=dataset.collate_fn,
-                shuffle=shuffle,
-                num_workers=self.num_workers,
-                sampler=None,
+                shuffle=shuffle and sampler is None,
+                sampler=sampler,
+                **loader_kwargs,
             )
 
     def train_dataloader(self) -> DataLoader:
@@ -425,8 +614,74 @@ class SummarizationModule(BaseTransformer):
         parser.add_argument("--fc_layer", action='store_true', default = False)
 
         parser.add_argument("--freeze_embeds", action="store_true")
+        parser.add_argument("--compile", action="store_true", default=False, help="torch.compile the model forward")
+        parser.add_argument(
+            "--compile_mode",
+            type=str,
+            default=None,
+            choices=["default", "reduce-overhead", "max-autotune"],
+            help="torch.compile mode for --compile; reduce-overhead also captures CUDA graphs for small batches",
+        )
+        parser.add_argument(
+            "--compile_layers",
+            action="store_true",
+            default=False,
+            help="torch.compile each decoder layer and graph attention layer instead of the whole model",
+        )
+        parser.add_argument(
+            "--gat_bf16",
+            action="store_true",
+            default=False,
+            help="run the graph attention matmuls under bf16 autocast (needs torch>=1.10 and a bf16 GPU)",
+        )
+        parser.add_argument(
+            "--fused_lm_loss",
+            action="store_true",
+            default=False,
+            help="compute the training loss over chunks of the LM head without materializing the full logits",
+        )
+        parser.add_argument(
+            "--quantize_ffn",
+            action="store_true",
+            default=False,
+            help="int8 dynamic quantization of the decoder/encoder feed-forward layers for the test run (CPU only)",
+        )
+        parser.add_argument(
+            "--quantize_lm_head",
+            action="store_true",
+            default=False,
+            help="use an int8 dynamically quantized copy of the LM head for the test run (CPU only)",
+        )
         parser.add_argument("--sortish_sampler", action="store_true", default=False)
         parser.add_argument("--max_tokens_per_batch", type=int, default=None)
+        parser.add_argument(
+            "--rouge_workers",
+            type=int,
+            default=0,
+            required=False,
+            help="processes that compute ROUGE in the background during eval, 0 computes it inline",
+        )
+        parser.add_argument(
+            "--token_cache",
+            action="store_true",
+            default=False,
+            help="tokenize each split once in prepare_data and memory-map the ids instead of tokenizing in collate_fn",
+        )
+        parser.add_argument(
+            "--val_loss_every",
+            type=int,
+            default=1,
+            required=False,
+            help="only compute the teacher-forced loss on every n-th val/test batch (default: all of them); "
+            "ROUGE still uses all of them, but val_loss/test_loss and --val_metric loss then see only the subsample",
+        )
+        parser.add_argument(
+            "--bucket_sampler",
+            action="store_true",
+            default=False,
+            help="Use length-bucketed batches sized to a token budget instead of fixed-size batches. "
+            "Needs token lengths, i.e. a .len file (save_len_file.py) or --token_cache.",
+        )
         parser.add_argument("--logger_name", type=str, choices=["default", "wandb", "wandb_shared"], default="default")
         parser.add_argument("--n_train", type=int, default=-1, required=False, help="# examples. -1 means use all.")
         parser.add_argument("--n_val", type=int, default=-1, required=False, help="# examples. -1 means use all.")
@@ -474,6 +729,11 @@ class SummarizationModule(BaseTransformer):
 
 def main(args, model=None) -> SummarizationModule:
     Path(args.output_dir).mkdir(exist_ok=True)
+    # TF32 tensor cores for fp32 matmuls on Ampere+; set_float32_matmul_precision only exists from torch 1.12
+    if hasattr(torch, "set_float32_matmul_precision"):
+        torch.set_float32_matmul_precision("high")
+    else:
+        torch.backends.cuda.matmul.allow_tf32 = True
     #print(args.do_train)
     if len(os.listdir(args.output_dir)) > 3 and args.do_train:
         raise ValueError("Output directory ({}) already exists and is not empty.".format(args.output_dir))
@@ -517,15 +777,17 @@ def main(args, model=None) -> SummarizationModule:
         early_stopping_callback=es_callback,
         logger=logger,
     )
-    pickle_save(model.hparams, model.output_dir / "hparams.pkl")
+    if trainer.is_global_zero:
+        pickle_save(model.hparams, model.output_dir / "hparams.pkl")
     if not args.do_predict:
         return model
 
     model.hparams.test_checkpoint = ""
-    checkpoints = list(sorted(glob.glob(os.path.join(args.output_dir, "*.ckpt"), recursive=True)))
-    if checkpoints:
-        model.hparams.test_checkpoint = checkpoints[-1]
-        trainer.resume_from_checkpoint = checkpoints[-1]
+    # checkpoint names start with the val metric, so the lexicographic max is what sorted(...)[-1] used to pick
+    checkpoint = max(glob.glob(os.path.join(args.output_dir, "*.ckpt")), default=None)
+    if checkpoint is not None:
+        model.hparams.test_checkpoint = checkpoint
+        trainer.resume_from_checkpoint = checkpoint
     trainer.logger.log_hyperparams(model.hparams)
 
     # test() without a model tests using the best checkpoint automatically
@@ -1,3 +1,4 @@
+import inspect
 import itertools
 import json
 import linecache
@@ -12,6 +13,7 @@ from typing import Callable, Dict, Iterable, List, Union
 import numpy as np
 import torch
 import torch.distributed as dist
+import torch.nn.functional as F
 from rouge_score import rouge_scorer, scoring
 from torch import nn
 from torch.utils.data import Dataset, Sampler
@@ -49,6 +51,32 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100):
     return loss, nll_loss
 
 
+# torch.inference_mode was added in torch 1.9; no_grad is the closest equivalent before that
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+# F.cross_entropy only accepts label_smoothing from torch 1.10 onwards
+NATIVE_LABEL_SMOOTHING = "label_smoothing" in inspect.signature(F.cross_entropy).parameters
+
+
+def label_smoothed_cross_entropy(logits, target, epsilon, ignore_index=-100):
+    """Summed label_smoothed_nll_loss computed from logits, without materializing log_softmax(logits)."""
+    if NATIVE_LABEL_SMOOTHING:
+        return F.cross_entropy(
+            logits.view(-1, logits.size(-1)),
+            target.view(-1),
+            ignore_index=ignore_index,
+            reduction="sum",
+            label_smoothing=epsilon,
+        )
+    # with lprobs = logits - logsumexp(logits), both fairseq terms reduce to per-token sums over the logits
+    lse = logits.logsumexp(dim=-1)
+    keep = target.ne(ignore_index)
+    nll_loss = lse - logits.gather(dim=-1, index=target.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+    smooth_loss = lse * logits.size(-1) - logits.sum(dim=-1)
+    loss = (1.0 - epsilon) * nll_loss + (epsilon / logits.size(-1)) * smooth_loss
+    return loss.masked_fill(~keep, 0.0).sum()
+
+
 def encode_line(tokenizer, line, max_length, pad_to_max_length=True, return_tensors="pt"):
     """Only used by LegacyDataset"""
     extra_kw = {"add_prefix_space": True} if isinstance(tokenizer, BartTokenizer) else {}
@@ -65,6 +93,27 @@ def lmap(f: Callable, x: Iterable) -> List:
     """list(map(f, x))"""
     return list(map(f, x))
 
+
+class _Utf8EscapeTable(dict):
+    """str.translate table for non-ASCII characters, filled lazily and cached per code point."""
+
+    def __missing__(self, codepoint):
+        escaped = "".join("\\x{:02x}".format(b) for b in chr(codepoint).encode("utf-8", "surrogatepass"))
+        self[codepoint] = escaped
+        return escaped
+
+
+_UTF8_ESCAPE_TABLE = _Utf8EscapeTable({c: str(bytes([c]))[2:-1] for c in range(128)})
+
+
+def utf8_escape(text: str) -> str:
+    """str(text.encode('utf-8'))[2:-1] in a single C-level pass"""
+    escaped = text.translate(_UTF8_ESCAPE_TABLE)
+    if "'" in text and '"' in text:
+        # bytes.__repr__ only falls back to '-quoting (and escapes ') when both quote kinds appear
+        escaped = escaped.replace("'", "\\'")
+    return escaped
+
 def trim_batch(
     input_ids,
     pad_token_id,
@@ -93,6 +142,7 @@ class AbstractSeq2SeqDataset(Dataset):
         action_graph = False,
         random_graph = False,
         use_graph=False,
+        token_cache=False,
     ):
         super().__init__()
         self.src_file = Path(data_dir).joinpath(type_path + ".source")
@@ -139,9 +189,66 @@ class AbstractSeq2SeqDataset(Dataset):
         self.tgt_lang = tgt_lang
         self.add_prefix_space = isinstance(self.tokenizer, BartTokenizer)
 
+        self.src_ids = self.tgt_ids = self.adj_values = None
+        if token_cache:
+            self.load_token_cache()
+
     def __len__(self):
         return len(self.src_lens)
 
+    def adj_cache_files(self):
+        stem = self.edge_file.with_suffix("")
+        return Path(f"{stem}.values.npy"), Path(f"{stem}.shapes.npy")
+
+    def get_adj(self, i):
+        if self.adj_values is None:
+            return self.edges[i]
+        return self.adj_values[self.adj_offsets[i] : self.adj_offsets[i + 1]].reshape(self.adj_shapes[i])
+
+    def token_cache_prefix(self) -> Path:
+        tag = f"{self.tokenizer.__class__.__name__}.{self.max_source_length}-{self.max_target_length}"
+        return self.src_file.with_name(f"{self.src_file.stem}.{tag}")
+
+    def write_token_cache(self):
+        """Tokenize every source/target line once into flat int32 arrays plus offsets, and the graphs into uint8."""
+        prefix = self.token_cache_prefix()
+        for side, data_file, max_length, line_prefix in (
+            ("source", self.src_file, self.max_source_length, self.prefix),
+            ("target", self.tgt_file, self.max_target_length, ""),
+        ):
+            ids_file, offsets_file = Path(f"{prefix}.{side}_ids.npy"), Path(f"{prefix}.{side}_offsets.npy")
+            if ids_file.exists() and offsets_file.exists():
+                continue
+            lines = [line_prefix + line.rstrip("\n") for line in Path(data_file).open().readlines()]
+            ids = self.tokenizer(
+                lines, max_length=max_length, truncation=True, add_prefix_space=self.add_prefix_space
+            )["input_ids"]
+            np.save(offsets_file, np.cumsum([0] + [len(x) for x in ids], dtype=np.int64))
+            np.save(ids_file, np.fromiter(itertools.chain.from_iterable(ids), dtype=np.int32))
+        values_file, shapes_file = self.adj_cache_files()
+        if not (values_file.exists() and shapes_file.exists()):
+            # graphs differ in size between examples, so flatten them like the ids and keep each one's shape
+            adjs = [np.asarray(adj, dtype=np.uint8) for adj in self.edges]
+            np.save(shapes_file, np.array([adj.shape for adj in adjs], dtype=np.int64))
+            np.save(values_file, np.concatenate([adj.ravel() for adj in adjs]))
+
+    def load_token_cache(self):
+        """Memory-map the arrays written by write_token_cache, if they exist; otherwise keep tokenizing in collate_fn."""
+        prefix = self.token_cache_prefix()
+        files = [Path(f"{prefix}.{side}_{kind}.npy") for side in ("source", "target") for kind in ("ids", "offsets")]
+        if not all(f.exists() for f in files):
+            logger.info(f"no token cache at {prefix}.*, tokenizing on the fly")
+            return
+        self.src_ids, self.src_offsets, self.tgt_ids, self.tgt_offsets = [np.load(f, mmap_mode="r") for f in files]
+        values_file, shapes_file = self.adj_cache_files()
+        if values_file.exists() and shapes_file.exists():
+            self.adj_values = np.load(values_file, mmap_mode="r")
+            self.adj_shapes = np.load(shapes_file)
+            self.adj_offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.adj_shapes], dtype=np.int64)
+        # exact token lengths for the samplers, instead of the character counts or the separate .len file
+        self.src_lens = np.diff(self.src_offsets)[: len(self.src_lens)].tolist()
+        self.used_char_len = False
+
     @staticmethod
     def get_char_lens(data_file):
         return [len(x) for x in Path(data_file).open().readlines()]
@@ -182,6 +289,16 @@ class AbstractSeq2SeqDataset(Dataset):
         )
         return shuffled_batches
 
+    def make_bucket_sampler(self, max_tokens_per_batch, distributed=False, shuffle=True, **kwargs):
+        assert not self.used_char_len, "You must call  python save_len_file.py before calling make_bucket_sampler"
+        lengths = np.fromiter(self.src_lens, dtype=np.int64, count=len(self.src_lens))
+        # truncated examples cost max_source_length tokens, and every example decodes up to max_target_length
+        lengths = np.minimum(lengths, self.max_source_length) + self.max_target_length
+        if distributed:
+            return DistributedBucketBatchSampler(lengths, max_tokens_per_batch, shuffle=shuffle, **kwargs)
+        else:
+            return BucketBatchSampler(lengths, max_tokens_per_batch, shuffle=shuffle)
+
     def __getitem__(self, item):
         raise NotImplementedError("You must implement this")
 
@@ -230,24 +347,44 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
     def __getitem__(self, index) -> Dict[str, str]:
         #TODO: add adj matrix
         index = index + 1  # linecache starts at 1
-        source_line = self.prefix + linecache.getline(str(self.src_file), index).rstrip("\n")
-        tgt_line = linecache.getline(str(self.tgt_file), index).rstrip("\n")
-
-        adj = self.edges[index-1]
-
-        if self.action_graph:
-            action_adj = self.action_adj[index-1]
-            actions = self.actions[index-1]
+        adj = self.get_adj(index-1)
+
+        if self.src_ids is not None:
+            # pre-tokenized ids, collate_fn only has to pad them
+            example = {
+                "src_ids": self.src_ids[self.src_offsets[index - 1] : self.src_offsets[index]],
+                "tgt_ids": self.tgt_ids[self.tgt_offsets[index - 1] : self.tgt_offsets[index]],
+                "id": index - 1,
+                "adj": adj,
+            }
+        else:
+            source_line = self.prefix + linecache.getline(str(self.src_file), index).rstrip("\n")
+            tgt_line = linecache.getline(str(self.tgt_file), index).rstrip("\n")
+            assert source_line, f"empty source line for index {index}"
+            assert tgt_line, f"empty tgt line for index {index}"
+            example = {"tgt_texts": tgt_line, "src_texts": source_line, "id": index - 1, "adj": adj}
 
-        assert source_line, f"empty source line for index {index}"
-        assert tgt_line, f"empty tgt line for index {index}"
         if self.action_graph:
-            return {"tgt_texts": tgt_line, "src_texts": source_line, "id": index - 1, "adj": adj, "actions": actions, "action_adj": action_adj}
-        else:
-            return {"tgt_texts": tgt_line, "src_texts": source_line, "id": index - 1, "adj": adj}
+            example["action_adj"] = self.action_adj[index-1]
+            example["actions"] = self.actions[index-1]
+        return example
         
+    def pad_token_ids(self, ids: List[np.ndarray]) -> torch.Tensor:
+        padded = np.full((len(ids), max(len(x) for x in ids)), self.pad_token_id, dtype=np.int64)
+        for row, x in zip(padded, ids):
+            row[: len(x)] = x
+        return torch.from_numpy(padded)
+
     def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
-        """Call prepare_seq2seq_batch."""
+        """Call prepare_seq2seq_batch, or pad the pre-tokenized ids when the token cache is loaded."""
+        if self.src_ids is not None:
+            input_ids = self.pad_token_ids([x["src_ids"] for x in batch])
+            batch_encoding = {
+                "input_ids": input_ids,
+                "attention_mask": input_ids.ne(self.pad_token_id).long(),
+                "labels": self.pad_token_ids([x["tgt_ids"] for x in batch]),
+            }
+            return self.collate_graphs(batch, batch_encoding)
         batch_encoding: Dict[str, torch.Tensor] = self.tokenizer.prepare_seq2seq_batch(
             [x["src_texts"] for x in batch],
             src_lang=self.src_lang,
@@ -258,23 +395,24 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
             return_tensors="pt",
             add_prefix_space=self.add_prefix_space,
         ).data
+        return self.collate_graphs(batch, batch_encoding)
 
-
+    def collate_graphs(self, batch, batch_encoding: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         batch_encoding["ids"] = torch.tensor([x["id"] for x in batch])
+        # decided here on the CPU tensor, the model would otherwise need a device sync to find out
+        batch_encoding["src_has_padding"] = bool(batch_encoding["attention_mask"].eq(0).any())
 
-        batch_encoding["adj"] = torch.tensor([x['adj'] for x in batch])
+        # edge labels are relation ids < 18 (0 = no edge), so uint8 moves 8x fewer bytes than the default int64
+        batch_encoding["adj"] = torch.from_numpy(np.stack([np.asarray(x['adj'], dtype=np.uint8) for x in batch]))
         
 
         if self.action_graph:
-            batch_encoding["action_adj"] = torch.tensor([x['action_adj'] for x in batch])
+            batch_encoding["action_adj"] = torch.tensor([x['action_adj'] for x in batch], dtype=torch.uint8)
 
             batch_encoding2: Dict[str, torch.Tensor] = self.tokenizer.prepare_seq2seq_batch(
                 [x["actions"] for x in batch],
                 src_lang=self.src_lang,
-                tgt_texts=[x["tgt_texts"] for x in batch],
-                tgt_lang=self.tgt_lang,
                 max_length=self.max_source_length,
-                max_target_length=self.max_target_length,
                 return_tensors="pt",
                 add_prefix_space=self.add_prefix_space,
             ).data
@@ -321,6 +459,95 @@ def sortish_sampler_indices(data: List, bs: int, shuffle=True) -> np.array:
     return sort_idx
 
 
+def bucket_batch_indices(lengths: np.ndarray, max_tokens: int, shuffle=True) -> List[np.ndarray]:
+    """Group examples of similar length into batches whose padded size (max_len * n) stays within max_tokens."""
+    if shuffle:
+        # only ties are shuffled: the sorted lengths, and so the number and shape of the batches, are the same
+        # every epoch (len() and the lr schedule stay right), while the examples sharing a length regroup
+        order = np.lexsort((np.random.rand(len(lengths)), lengths))
+    else:
+        order = np.argsort(lengths, kind="stable")
+    batches, start = [], 0
+    sorted_lens = lengths[order].tolist()
+    while start < len(order):
+        end = start + 1
+        batch_max = sorted_lens[start]
+        while end < len(order):
+            batch_max = max(batch_max, sorted_lens[end])
+            if batch_max * (end - start + 1) > max_tokens:
+                break
+            end += 1
+        batches.append(order[start:end])
+        start = end
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+        # move the largest batch to the front to OOM quickly
+        largest = int(np.argmax([lengths[b].max() * len(b) for b in batches]))
+        batches[0], batches[largest] = batches[largest], batches[0]
+    return batches
+
+
+class BucketBatchSampler(Sampler):
+    "Yield batches of indices of similar length, sized to a token budget instead of a fixed batch size."
+
+    def __init__(self, lengths, max_tokens, shuffle=True):
+        self.lengths, self.max_tokens, self.shuffle = lengths, max_tokens, shuffle
+        self.batches = bucket_batch_indices(lengths, max_tokens, shuffle=shuffle)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self):
+        batches = self.batches
+        # rebuild for the next epoch so that every epoch sees a different grouping
+        if self.shuffle:
+            self.batches = bucket_batch_indices(self.lengths, self.max_tokens, shuffle=True)
+        return (b.tolist() for b in batches)
+
+
+class DistributedBucketBatchSampler(Sampler):
+    """BucketBatchSampler that gives every replica the same number of batches, seeded by epoch."""
+
+    def __init__(self, lengths, max_tokens, num_replicas=None, rank=None, shuffle=True):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        self.lengths, self.max_tokens, self.shuffle = lengths, max_tokens, shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_batches = int(math.ceil(len(self._all_batches()) * 1.0 / self.num_replicas))
+
+    def _all_batches(self) -> List[np.ndarray]:
+        # every replica must draw the same batches, so seed numpy from the epoch
+        state = np.random.get_state()
+        np.random.seed(self.epoch)
+        try:
+            return bucket_batch_indices(self.lengths, self.max_tokens, shuffle=self.shuffle)
+        finally:
+            np.random.set_state(state)
+
+    def __iter__(self) -> Iterable:
+        batches = self._all_batches()
+        # Lightning only calls set_epoch on samplers, not batch samplers, so advance the seed ourselves
+        self.epoch += 1
+        # add extra batches to make it evenly divisible
+        total_size = self.num_batches * self.num_replicas
+        batches += batches[: (total_size - len(batches))]
+        return (b.tolist() for b in batches[self.rank : total_size : self.num_replicas][: self.num_batches])
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
 class DistributedSortishSampler(Sampler):
     """Copied from torch DistributedSampler"""
 
@@ -400,7 +627,7 @@ def pickle_save(obj, path):
 
 
 def flatten_list(summary_ids: List[List]):
-    return [x for x in itertools.chain.from_iterable(summary_ids)]
+    return list(itertools.chain.from_iterable(summary_ids))
 
 
 
@@ -1036,8 +1036,8 @@ class ModelOutput(OrderedDict):
 
     def __getitem__(self, k):
         if isinstance(k, str):
-            inner_dict = {k: v for (k, v) in self.items()}
-            return inner_dict[k]
+            # the set (non ``None``) fields are the dict items, no need to copy them into a new dict first
+            return super().__getitem__(k)
         else:
             return self.to_tuple()[k]
 
@@ -1057,4 +1057,4 @@ class ModelOutput(OrderedDict):
         """
         Convert self to a tuple containing all the attributes/keys that are not ``None``.
         """
-        return tuple(self[k] for k in self.keys())
+        return tuple(self.values())
@@ -214,6 +214,9 @@ class GenerationMixin:
                 speed up decoding.
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the :obj:`forward` function of the model.
+                For encoder-decoder models, a precomputed ``encoder_outputs`` (as returned by the encoder with
+                ``return_dict=True``) is used instead of running the encoder again. Its ``last_hidden_state`` is
+                replaced in place by the beam-expanded version.
 
         Return:
 
@@ -408,10 +411,12 @@ class GenerationMixin:
             assert hasattr(self, "get_encoder"), "{} should have a 'get_encoder' function defined".format(self)
             assert callable(self.get_encoder), "{} should be a method".format(self.get_encoder)
 
-            # get encoder and store encoder outputs
-            encoder = self.get_encoder()
-            #print('attn_mask', attention_mask)
-            encoder_outputs: ModelOutput = encoder(input_ids, attention_mask=attention_mask, return_dict=True, segmented_encoder = segmented_encoder)
+            # get encoder and store encoder outputs, unless the caller already ran the encoder on input_ids
+            encoder_outputs: ModelOutput = model_kwargs.pop("encoder_outputs", None)
+            if encoder_outputs is None:
+                encoder = self.get_encoder()
+                #print('attn_mask', attention_mask)
+                encoder_outputs = encoder(input_ids, attention_mask=attention_mask, return_dict=True, segmented_encoder = segmented_encoder)
             
             graph_outputs, section_padding_mask = None, None
             sent_outputs, sent_padding_mask = None, None
@@ -18,11 +18,10 @@ import random
 import warnings
 from typing import Dict, List, Optional, Tuple
 
-from torch.nn.utils.rnn import pad_sequence
-
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import Tensor, nn
 from torch.nn import CrossEntropyLoss
 
@@ -46,6 +45,16 @@ from .modeling_outputs import (
 from .modeling_utils import PreTrainedModel
 from .utils import logging
 
+
+try:
+    from flash_attn import flash_attn_varlen_func
+
+    FLASH_ATTN_AVAILABLE = True
+except ImportError:
+    FLASH_ATTN_AVAILABLE = False
+
+SDPA_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+
 logger = logging.get_logger(__name__)
 
 _CONFIG_FOR_DOC = "BartConfig"
@@ -133,14 +142,40 @@ BART_INPUTS_DOCSTRING = r"""
 def invert_mask(attention_mask):
     """Turns 1->0, 0->1, False->True, True-> False"""
     assert attention_mask.dim() == 2
+    if attention_mask.dtype == torch.bool:
+        return ~attention_mask
     return attention_mask.eq(0)
 
 
+def _drop_unpadded_mask(attention_mask):
+    """None for a source mask without padding, so incremental decoding does not merge or apply a mask that masks
+    nothing in every cross-attention layer (and SDPA can take its unmasked fast path). Syncs with the device, so
+    call it once per ``generate``, not per step."""
+    if attention_mask is not None and not bool(attention_mask.eq(0).any()):
+        return None
+    return attention_mask
+
+
+def _decoding_scratch(like, shape):
+    """Empty buffer shaped ``shape`` for reuse across cached decoding steps. It is allocated as a normal tensor even
+    under ``torch.inference_mode``, so a later in-place write under plain ``no_grad`` is still allowed."""
+    if hasattr(torch, "inference_mode"):
+        with torch.inference_mode(False):
+            return torch.empty(shape, dtype=like.dtype, device=like.device)
+    return torch.empty(shape, dtype=like.dtype, device=like.device)
+
+
 def _prepare_bart_decoder_inputs(
-        config, input_ids, decoder_input_ids=None, decoder_padding_mask=None, causal_mask_dtype=torch.float32
+        config,
+        input_ids,
+        decoder_input_ids=None,
+        decoder_padding_mask=None,
+        causal_mask_dtype=torch.float32,
+        causal_mask=None,
 ):
     """Prepare masks that ignore padding tokens in the decoder and a causal mask for the decoder if
     none are provided. This mimics the default behavior in fairseq. To override it pass in masks.
+    ``causal_mask`` may be a precomputed, larger causal mask (e.g. ``BartModel.causal_mask``) to slice from.
     Note: this is not called during generation
     """
     pad_token_id = config.pad_token_id
@@ -154,13 +189,18 @@ def _prepare_bart_decoder_inputs(
     if decoder_padding_mask is not None and decoder_padding_mask.shape[1] > 1:
         # never mask leading token, even if it is pad
         decoder_padding_mask[:, 0] = decoder_padding_mask[:, 1]
-    tmp = fill_with_neg_inf(torch.zeros(tgt_len, tgt_len))
-    mask = torch.arange(tmp.size(-1))
-    tmp.masked_fill_(mask < (mask + 1).view(tmp.size(-1), 1), 0)
-    causal_mask = tmp.to(dtype=causal_mask_dtype, device=decoder_input_ids.device)
+    if causal_mask is not None and causal_mask.size(0) >= tgt_len:
+        causal_mask = causal_mask[:tgt_len, :tgt_len].to(dtype=causal_mask_dtype, device=decoder_input_ids.device)
+    else:
+        causal_mask = _make_causal_mask(tgt_len, causal_mask_dtype, decoder_input_ids.device)
     return decoder_input_ids, decoder_padding_mask, causal_mask
 
 
+def _make_causal_mask(tgt_len, dtype=torch.float32, device=None):
+    """(tgt_len, tgt_len) mask with -inf above the diagonal, built directly on ``device``."""
+    return torch.triu(torch.full((tgt_len, tgt_len), float("-inf"), device=device), diagonal=1).to(dtype)
+
+
 class PretrainedBartModel(PreTrainedModel):
     config_class = BartConfig
     base_model_prefix = "model"
@@ -188,6 +228,18 @@ class PretrainedBartModel(PreTrainedModel):
         }
         return dummy_inputs
 
+    def quantize_ffn_(self):
+        """Dynamically quantize the ``fc1``/``fc2`` feed-forward projections of every layer to int8, in place.
+
+        Meant for CPU inference after the weights are loaded: int8 dynamic quantization has no CUDA kernels and
+        the quantized layers cannot be trained.
+        """
+        ffn_names = {
+            name for name, module in self.named_modules() if name.endswith((".fc1", ".fc2")) and isinstance(module, nn.Linear)
+        }
+        torch.quantization.quantize_dynamic(self, ffn_names, dtype=torch.qint8, inplace=True)
+        return self
+
 
 def _make_linear_from_emb(emb):
     vocab_size, emb_size = emb.weight.shape
@@ -204,10 +256,10 @@ def _check_shapes(shape_1, shape2):
 
 def shift_tokens_right(input_ids, pad_token_id):
     """Shift input ids one token to the right, and wrap the last non pad token (usually <eos>)."""
-    prev_output_tokens = input_ids.clone()
-    index_of_eos = (input_ids.ne(pad_token_id).sum(dim=1) - 1).unsqueeze(-1)
-    prev_output_tokens[:, 0] = input_ids.gather(1, index_of_eos).squeeze()
-    prev_output_tokens[:, 1:] = input_ids[:, :-1]
+    # roll already moves every token one step right, only column 0 (which got the last column) needs fixing
+    prev_output_tokens = input_ids.roll(1, dims=1)
+    index_of_eos = input_ids.ne(pad_token_id).sum(dim=1, keepdim=True).sub_(1)
+    prev_output_tokens[:, 0] = input_ids.gather(1, index_of_eos).squeeze(1)
     return prev_output_tokens
 
 
@@ -219,6 +271,131 @@ def make_padding_mask(input_ids, padding_idx=1):
     return padding_mask
 
 
+@torch.jit.script
+def _utterance_spans(input_ids: Tensor, bos: int = 0, eos: int = 2) -> Tuple[Tensor, Tensor, Tensor]:
+    """Row, start column and length of every ``<s> ... </s>`` utterance in ``input_ids``."""
+    bsz = input_ids.size(0)
+    starts = torch.nonzero(input_ids == bos)
+    ends = torch.nonzero(input_ids == eos)
+    # the j-th </s> of a row closes its j-th <s>; a trailing <s> whose </s> was truncated away is dropped
+    ends_per_row = torch.bincount(ends[:, 0], minlength=bsz)
+    starts_per_row = torch.bincount(starts[:, 0], minlength=bsz)
+    start_rank = torch.arange(starts.size(0), device=input_ids.device) - (
+        torch.cumsum(starts_per_row, 0) - starts_per_row
+    )[starts[:, 0]]
+    starts = starts[start_rank < ends_per_row[starts[:, 0]]]
+    rows = starts[:, 0]
+    seg_start = starts[:, 1]
+    return rows, seg_start, ends[:, 1] - seg_start + 1
+
+
+@torch.jit.script
+def _utterance_token_index(rows: Tensor, lens: Tensor, bsz: int) -> Tuple[Tensor, Tensor]:
+    """Row and position in the original sequence of every utterance token, in utterance order."""
+    token_rows = torch.repeat_interleave(rows, lens)
+    # utterances of a row are consecutive, so a token's position is its rank after the row's first token
+    row_lens = torch.zeros([bsz], dtype=lens.dtype, device=lens.device).index_add_(0, rows, lens)
+    row_offsets = torch.cumsum(row_lens, 0) - row_lens
+    token_pos = torch.arange(token_rows.size(0), device=lens.device) - row_offsets[token_rows]
+    return token_rows, token_pos
+
+
+def _gather_segments(hidden_states, input_ids, num_segments=None, pad_to_multiple_of=None):
+    """The state at every ``<s>`` (id 0) of ``input_ids`` in a zero-padded ``(B, num_segments, hid)`` batch.
+
+    Returns it with the ``(B, num_segments)`` mask of real segments, derived from the per-row counts;
+    ``num_segments`` defaults to the largest count, rounded up to ``pad_to_multiple_of`` if given.
+    """
+    starts = input_ids.eq(0)
+    counts = starts.sum(1)
+    if num_segments is None:
+        num_segments = int(counts.max())
+        if pad_to_multiple_of is not None:
+            num_segments = -(-num_segments // pad_to_multiple_of) * pad_to_multiple_of
+    sample_idx, seq_idx = starts.nonzero(as_tuple=True)
+    segment_idx = (starts.cumsum(1) - 1)[sample_idx, seq_idx]
+    segments = hidden_states.new_zeros(input_ids.size(0), num_segments, hidden_states.size(-1))
+    segments[sample_idx, segment_idx] = hidden_states[sample_idx, seq_idx]
+    # bool (True for real segments): every consumer goes through invert_mask, which takes bool masks as they are
+    padding_mask = torch.arange(num_segments, device=input_ids.device)[None, :] < counts[:, None]
+    return segments, padding_mask
+
+
+@torch.jit.script
+def _embed_layer_norm_dropout(
+    inputs_embeds: Tensor,
+    embed_pos: Tensor,
+    weight: Optional[Tensor],
+    bias: Optional[Tensor],
+    eps: float,
+    p: float,
+    training: bool,
+) -> Tensor:
+    """Position add, embedding LayerNorm and dropout as one scripted block the fuser can merge."""
+    x = F.layer_norm(inputs_embeds + embed_pos, [inputs_embeds.size(-1)], weight, bias, eps)
+    return F.dropout(x, p, training)
+
+
+def _dropout_add_layer_norm(
+    x, residual, p: float, training: bool, weight=None, bias=None, eps: float = 1e-5, scale=None
+):
+    """Dropout, optionally rezero-scaled residual add and post LayerNorm (skipped when ``weight`` is None): the
+    pointwise tail of a sublayer.
+
+    It takes the LayerNorm's tensors rather than the module, so that with ``config.use_torch_compile`` every layer's
+    compiled region shares one graph for it and inductor fuses the three ops into one pass over the activations.
+    """
+    x = F.dropout(x, p=p, training=training)
+    x = residual + x if scale is None else torch.addcmul(residual, scale, x)
+    return x if weight is None else F.layer_norm(x, x.shape[-1:], weight, bias, eps)
+
+
+def _layer_norm_params(layer_norm):
+    """``(weight, bias, eps)`` of ``layer_norm`` for :func:`_dropout_add_layer_norm`, Nones to leave out the norm."""
+    if layer_norm is None:
+        return None, None, 1e-5
+    return layer_norm.weight, layer_norm.bias, layer_norm.eps
+
+
+def _compile_regions(modules):
+    """torch.compile the forward of each module in place, leaving parameter names (and so checkpoints) unchanged."""
+    for module in modules:
+        module.forward = torch.compile(module.forward, dynamic=True)
+
+
+def _linear_cross_entropy_sum(x, weight, bias, labels, ignore_index: int):
+    return F.cross_entropy(F.linear(x, weight, bias), labels, ignore_index=ignore_index, reduction="sum")
+
+
+def fused_linear_cross_entropy(
+    hidden_states, weight, bias, labels, ignore_index=-100, chunk_size=None, chunk_bytes=64 * 1024 * 1024
+):
+    """Mean cross entropy of ``F.linear(hidden_states, weight, bias)`` against ``labels``, without the full logits.
+
+    The rows go through the projection and the loss ``chunk_size`` at a time. Under autograd every chunk is
+    checkpointed, so only one ``(chunk_size, vocab_size)`` block of logits is alive at once and the backward
+    recomputes it instead of keeping the whole ``(B, T, vocab_size)`` tensor around. By default ``chunk_size`` is
+    derived from the vocabulary so that a block takes about ``chunk_bytes`` (~330 rows for BART's 50265 tokens in
+    fp32), small enough to actually split a batch.
+    """
+    if chunk_size is None:
+        chunk_size = max(1, chunk_bytes // (weight.size(0) * weight.element_size()))
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+    labels = labels.reshape(-1)
+    if bias is not None:
+        bias = bias.view(-1)
+    needs_grad = torch.is_grad_enabled() and (hidden_states.requires_grad or weight.requires_grad)
+    loss = None
+    for start in range(0, labels.size(0), chunk_size):
+        args = (hidden_states[start : start + chunk_size], weight, bias, labels[start : start + chunk_size], ignore_index)
+        if needs_grad:
+            chunk_loss = torch.utils.checkpoint.checkpoint(_linear_cross_entropy_sum, *args)
+        else:
+            chunk_loss = _linear_cross_entropy_sum(*args)
+        loss = chunk_loss if loss is None else loss + chunk_loss
+    return loss / labels.ne(ignore_index).sum()
+
+
 # Helper Modules
 
 
@@ -240,12 +417,13 @@ class EncoderLayer(nn.Module):
         self.fc2 = nn.Linear(config.encoder_ffn_dim, self.embed_dim)
         self.final_layer_norm = LayerNorm(self.embed_dim)
 
-    def forward(self, x, encoder_padding_mask, output_attentions=False):
+    def forward(self, x, encoder_padding_mask, output_attentions=False, cu_seqlens=None, max_seqlen=None):
         """
         Args:
-            x (Tensor): input to the layer of shape `(seq_len, batch, embed_dim)`
+            x (Tensor): input to the layer of shape `(seq_len, batch, embed_dim)`, or `(total_tokens, embed_dim)`
+                when the sequences are packed back to back and delimited by ``cu_seqlens``
             encoder_padding_mask (ByteTensor): binary ByteTensor of shape
-                `(batch, src_len)` where padding elements are indicated by ``1``.
+                `(batch, src_len)`, or `(batch, 1, 1, src_len)`, where padding elements are indicated by ``1``.
             for t_tgt, t_src is excluded (or masked out), =0 means it is
             included in attention
 
@@ -255,9 +433,12 @@ class EncoderLayer(nn.Module):
         residual = x
         if self.normalize_before:
             x = self.self_attn_layer_norm(x)
-        x, attn_weights = self.self_attn(
-            query=x, key=x, key_padding_mask=encoder_padding_mask, output_attentions=output_attentions
-        )
+        if cu_seqlens is not None:
+            x, attn_weights = self.self_attn.varlen_forward(x, cu_seqlens, max_seqlen), None
+        else:
+            x, attn_weights = self.self_attn(
+                query=x, key=x, key_padding_mask=encoder_padding_mask, output_attentions=output_attentions
+            )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
         if not self.normalize_before:
@@ -321,57 +502,37 @@ class BartEncoder(nn.Module):
         self.layer_norm = LayerNorm(config.d_model) if config.add_final_layer_norm else None
 
     def transform_format(self, input_ids):
-
-        divide_convs = []
-        utterances = []
-
-        for i in range(0, input_ids.shape[0]):
-
-            seg_start = torch.where(input_ids[i] == 0)[0]
-            seg_end = torch.where(input_ids[i] == 2)[0]
-
-            # print('start', seg_start)
-            # print('end', seg_end)
-            count = 0
-            for j in range(0, seg_end.shape[0]):
-                uttr = input_ids[i][seg_start[j]: seg_end[j] + 1]
-                utterances.append(uttr)
-                count += 1
-            divide_convs.append(count)
-
-        utterances = pad_sequence(utterances, batch_first=True, padding_value=1)
+        """Split every row into its ``<s> ... </s>`` utterances and stack them, padded with 1, as a new batch."""
+        src_len = input_ids.shape[1]
+        rows, seg_start, lens = _utterance_spans(input_ids)
+        max_len = int(lens.max()) if lens.numel() > 0 else 0
+        cols = torch.arange(max_len, device=input_ids.device)
         # utterance_num * max_len
+        positions = (seg_start[:, None] + cols[None, :]).clamp(max=src_len - 1)
+        # the gather already allocates the padded (utterance_num, max_len) output, so pad it in place
+        utterances = input_ids[rows[:, None], positions].masked_fill_(cols[None, :] >= lens[:, None], 1)
 
-        utterances_padding = utterances.eq(1)
-        # print(utterances_padding)
-        utterances_padding_mask = 1 - utterances_padding.type(torch.long)
-        # print(utterances_padding_mask)
-        return utterances, utterances_padding_mask, divide_convs
-
-    def transform_back(self, x, count, input_ids, original_input_ids):
-
-        convs = [torch.tensor(torch.zeros([original_input_ids.shape[1], x.shape[-1]]), requires_grad=True).to(x.device)]
-        # print(count)
-        for i in range(0, len(count)):
-            num_utter = count[i]
-            if i == 0:
-                start_ids = 0
-            else:
-                start_ids += count[i - 1]
-
-            temp_conv = []
-            # print(input_ids)
-            for j in range(0, num_utter):
-                seg_start = torch.where(input_ids[start_ids + j] == 0)[0][0]
-                seg_end = torch.where(input_ids[start_ids + j] == 2)[0][0]
-                # print(seg_start, seg_end)
-                temp_conv.append(x[start_ids + j][seg_start:seg_end + 1, :])
+        # kept as bool, invert_mask and the attention layers only need a bool mask
+        utterances_padding_mask = utterances.ne(1)
+        # which row each utterance came from and how many tokens it has, for transform_back
+        segments = (rows, lens)
+        return utterances, utterances_padding_mask, segments
 
-            # print(torch.cat(temp_conv, dim = 0).shape)
-            convs.append(torch.cat(temp_conv, dim=0))
+    def transform_back(self, x, segments, original_input_ids):
+        """Concatenate each row's utterance states back into one sequence, zero-padded to the original length.
 
-        convs = pad_sequence(convs, batch_first=True)
-        return convs[1:, :, :]
+        ``x`` is either the padded `(utterance_num, max_len, embed_dim)` states or the already packed
+        `(total_tokens, embed_dim)` ones of the varlen path.
+        """
+        rows, lens = segments
+        bsz, src_len = original_input_ids.shape
+        if x.dim() == 3:
+            valid = torch.arange(x.shape[1], device=x.device)[None, :] < lens[:, None]
+            x = x[valid]
+        token_rows, token_pos = _utterance_token_index(rows, lens, bsz)
+        convs = x.new_zeros((bsz, src_len, x.shape[-1]))
+        convs[token_rows, token_pos] = x
+        return convs
 
     def forward(
             self, input_ids, attention_mask=None, output_attentions=False, output_hidden_states=False,
@@ -400,33 +561,67 @@ class BartEncoder(nn.Module):
         x = original_input_ids
         if segmented_encoder:
             # print('before ids', input_ids.shape)
-            input_ids, attention_mask, count = self.transform_format(input_ids)
+            input_ids, attention_mask, segments = self.transform_format(input_ids)
             # print('after ids', input_ids.shape)
 
         # check attention mask and invert
         if attention_mask is not None:
-            attention_mask = invert_mask(attention_mask)
+            # shaped for broadcasting against (bsz, heads, tgt, src) once here, instead of in every layer
+            attention_mask = invert_mask(attention_mask)[:, None, None, :]
         if not sent_encoder:
-            inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
+            inputs_embeds = self.embed_tokens(input_ids)
+            if self.embed_scale != 1.0:  # scale_embedding is off for bart, skip the no-op pass
+                inputs_embeds = inputs_embeds * self.embed_scale
             embed_pos = self.embed_positions(input_ids)
-            x = inputs_embeds + embed_pos
-            x = self.layernorm_embedding(x)
-            x = F.dropout(x, p=self.dropout, training=self.training)
-
-        # B x T x C -> T x B x C
-        x = x.transpose(0, 1)
+            if isinstance(self.layernorm_embedding, nn.LayerNorm):
+                ln = self.layernorm_embedding
+                x = _embed_layer_norm_dropout(
+                    inputs_embeds, embed_pos, ln.weight, ln.bias, ln.eps, self.dropout, self.training
+                )
+            else:
+                # apex FusedLayerNorm or Identity, which already read x once
+                x = self.layernorm_embedding(inputs_embeds + embed_pos)
+                x = F.dropout(x, p=self.dropout, training=self.training, inplace=True)
+
+        # utterances, or padded rows, are packed back to back without padding when FlashAttention can run on them
+        cu_seqlens = max_seqlen = pack_mask = None
+        if (
+            not sent_encoder
+            and FLASH_ATTN_AVAILABLE
+            and x.is_cuda
+            and (x.dtype in (torch.float16, torch.bfloat16) or torch.is_autocast_enabled())
+            and not (output_attentions or output_hidden_states)
+        ):
+            if segmented_encoder:
+                lens = segments[1]
+                pack_mask = torch.arange(x.shape[1], device=x.device)[None, :] < lens[:, None]
+            elif original_attn_mask is not None:
+                pack_mask = original_attn_mask.bool()
+                lens = pack_mask.sum(1)
+        if pack_mask is not None:
+            cu_seqlens = F.pad(torch.cumsum(lens, 0), (1, 0)).int()
+            max_seqlen = x.shape[1]
+            x = x[pack_mask]
+        else:
+            # B x T x C -> T x B x C
+            x = x.transpose(0, 1)
 
         encoder_states = [] if output_hidden_states else None
         all_attentions = () if output_attentions else None
-        for encoder_layer in self.layers:
+        # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description), decided for all layers up front
+        if self.training and self.layerdrop > 0:
+            skip_layer = [random.uniform(0, 1) < self.layerdrop for _ in self.layers]
+        else:
+            skip_layer = [False] * len(self.layers)
+        for encoder_layer, skip in zip(self.layers, skip_layer):
             if output_hidden_states:
                 encoder_states.append(x)
-            # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
-            dropout_probability = random.uniform(0, 1)
-            if self.training and (dropout_probability < self.layerdrop):  # skip the layer
+            if skip:  # skip the layer
                 attn = None
             else:
-                x, attn = encoder_layer(x, attention_mask, output_attentions=output_attentions)
+                x, attn = encoder_layer(
+                    x, attention_mask, output_attentions=output_attentions, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen
+                )
 
             if output_attentions:
                 all_attentions = all_attentions + (attn,)
@@ -438,12 +633,18 @@ class BartEncoder(nn.Module):
             # T x B x C -> B x T x C
             encoder_states = tuple(hidden_state.transpose(0, 1) for hidden_state in encoder_states)
 
-        # T x B x C -> B x T x C
-        x = x.transpose(0, 1)
+        if cu_seqlens is None:
+            # T x B x C -> B x T x C
+            x = x.transpose(0, 1)
+        elif not segmented_encoder:
+            # unpack to B x T x C, padding positions are zero
+            packed = x
+            x = packed.new_zeros(pack_mask.shape + (packed.shape[-1],))
+            x[pack_mask] = packed
 
         if segmented_encoder:
             # print('before x', x.shape)
-            x = self.transform_back(x, count, input_ids, original_input_ids)
+            x = self.transform_back(x, segments, original_input_ids)
             attention_mask = original_attn_mask
             input_ids = original_input_ids
 
@@ -481,7 +682,8 @@ class DecoderLayer(nn.Module):
             encoder_decoder_attention=True,
         )
         self.encoder_attn_layer_norm = LayerNorm(self.embed_dim)
-        self.resweight = nn.Parameter(torch.Tensor([1]))
+        # shared rezero weight of the sent, discourse and composit residuals
+        self.resweight = nn.Parameter(torch.ones(1))
         self.sent_encoder = config.sent_encoder
 
         # TODO: added part
@@ -516,10 +718,6 @@ class DecoderLayer(nn.Module):
 
             # if config.no_rezero:
             #    self.combine_discourse_linear = nn.Linear(self.embed_dim * 2, self.embed_dim)
-            # if config.composit:
-            #    self.resweight = nn.Parameter(torch.Tensor([0]))
-            # else:
-            self.resweight = nn.Parameter(torch.Tensor([1]))
 
         if config.action_graph:
             self.action_attn = Attention(
@@ -529,7 +727,7 @@ class DecoderLayer(nn.Module):
                 action_decoder_attention=True,
             )
             self.action_attn_layer_norm = LayerNorm(self.embed_dim)
-            self.resweight_2 = nn.Parameter(torch.Tensor([1]))
+            self.resweight_2 = nn.Parameter(torch.ones(1))
 
         if config.composit:
             self.composit_layer = nn.Linear(self.embed_dim * 2, self.embed_dim)
@@ -538,6 +736,47 @@ class DecoderLayer(nn.Module):
         self.fc1 = nn.Linear(self.embed_dim, config.decoder_ffn_dim)
         self.fc2 = nn.Linear(config.decoder_ffn_dim, self.embed_dim)
         self.final_layer_norm = LayerNorm(self.embed_dim)
+        # fc1 output buffer for cached decoding steps, allocated on first use and reused while the shape is stable
+        self._scratch_fc1 = None
+
+        if __debug__:
+            # cross attentions share layer_state with self attention, so their cache slots must not collide
+            for name in ("encoder_attn", "sent_attn", "discourse_attn", "action_attn"):
+                attn = getattr(self, name, None)
+                assert attn is None or attn.cache_key != self.self_attn.cache_key, name
+
+    def _fc1(self, x, decoding):
+        """``fc1`` that, on cached single-token decoding steps without autograd, writes into a buffer reused across
+        steps. Full-sequence passes (training, validation loss) allocate as usual and keep nothing around."""
+        if (
+            not decoding
+            or torch.is_grad_enabled()
+            or torch.is_autocast_enabled()
+            or not isinstance(self.fc1, nn.Linear)
+        ):
+            return self.fc1(x)
+        shape = x.shape[:-1] + (self.fc1.out_features,)
+        scratch = self._scratch_fc1
+        if scratch is None or scratch.shape != shape or scratch.dtype != x.dtype or scratch.device != x.device:
+            scratch = self._scratch_fc1 = _decoding_scratch(x, shape)
+        torch.addmm(
+            self.fc1.bias, x.reshape(-1, x.size(-1)), self.fc1.weight.t(), out=scratch.view(-1, shape[-1])
+        )
+        return scratch
+
+    def _graph_attn(self, x, attn, layer_norm, key, key_padding_mask, layer_state):
+        """Pre-norm if configured, attention over graph states and dropout; the residual is left to the caller."""
+        if self.normalize_before:
+            x = layer_norm(x)
+        x, _ = attn(query=x, key=key, key_padding_mask=key_padding_mask, layer_state=layer_state)  # mutates layer state
+        return F.dropout(x, p=self.dropout, training=self.training)
+
+    def _composit(self, a, b):
+        """``composit_layer(torch.cat([a, b], -1))`` as two GEMMs on the weight halves, without the `2 * embed_dim` cat."""
+        weight_a, weight_b = self.composit_layer.weight.chunk(2, dim=1)
+        out = F.linear(a, weight_a, self.composit_layer.bias)
+        out += F.linear(b, weight_b)
+        return out
 
     def forward(
             self,
@@ -556,6 +795,8 @@ class DecoderLayer(nn.Module):
             sent_padding_mask=None,
     ):
         residual = x
+        # a cached generation step feeds one new token against the saved keys/values
+        decoding = layer_state is not None and x.size(0) == 1
 
         if layer_state is None:
             layer_state = {}
@@ -571,7 +812,9 @@ class DecoderLayer(nn.Module):
             attn_mask=causal_mask,
             output_attentions=output_attentions,
         )
-        x = F.dropout(x, p=self.dropout, training=self.training)
+        # x is the fresh out_proj output, so dropout can reuse its storage; the residual add stays out of place,
+        # since under autocast x is half and residual fp32, and an in-place add would round the residual stream
+        x = F.dropout(x, p=self.dropout, training=self.training, inplace=True)
         x = residual + x
         # x = residual + self.resweight * x
         if not self.normalize_before:
@@ -579,8 +822,6 @@ class DecoderLayer(nn.Module):
 
         # Cross attention
         residual = x
-        sent_x = x
-        assert self.encoder_attn.cache_key != self.self_attn.cache_key
         if self.normalize_before:
             x = self.encoder_attn_layer_norm(x)
         # print(encoder_hidden_states.shape)
@@ -590,28 +831,23 @@ class DecoderLayer(nn.Module):
             key_padding_mask=encoder_attn_mask,
             layer_state=layer_state,  # mutates layer state
         )
-        x = F.dropout(x, p=self.dropout, training=self.training)
+        x = F.dropout(x, p=self.dropout, training=self.training, inplace=True)
         if self.sent_encoder:
-            
-            assert self.sent_attn.cache_key != self.self_attn.cache_key
-            if self.normalize_before:
-                sent_x = self.sent_attn_layer_norm(sent_x)
             sent_x, _ = self.sent_attn(
-                query=sent_x,
+                query=self.sent_attn_layer_norm(residual) if self.normalize_before else residual,
                 key=sent_outputs,
                 key_padding_mask=sent_padding_mask,
                 layer_state=layer_state,  # mutates layer state
             )
             sent_x = F.dropout(sent_x, p=self.dropout, training=self.training)
             sent_x = self.resweight * sent_x
-            x = torch.cat([x, sent_x], dim=-1)
-            x = self.composit_layer(x)
-            x = F.dropout(x, p=self.dropout, training=self.training)
+            x = self._composit(x, sent_x)
+            x = F.dropout(x, p=self.dropout, training=self.training, inplace=True)
             # if self.no_rezero:
             #     x = residual + x
             # else:
             #     x = residual + self.resweight * x
-            x = residual +  x
+            x = residual + x
             if not self.normalize_before:
                 x = self.sent_attn_layer_norm(x)
         else:
@@ -621,119 +857,59 @@ class DecoderLayer(nn.Module):
                 x = self.encoder_attn_layer_norm(x)
 
         if not self.composit:
-            # print("...")
-            # Cross graph attention
-
+            # Cross graph attention, applied one after the other
             if self.discourse_graph:
                 residual = x
-                assert self.discourse_attn.cache_key != self.self_attn.cache_key
-                if self.normalize_before:
-                    x = self.discourse_attn_layer_norm(x)
-
-                # print(graph_outputs.shape)
-                # print(graph_outputs.shape, section_padding_mask.shape)
-                x, _ = self.discourse_attn(
-                    query=x,
-                    key=graph_outputs,
-                    key_padding_mask=section_padding_mask,
-                    layer_state=layer_state,  # mutates layer state
+                x = self._graph_attn(
+                    x, self.discourse_attn, self.discourse_attn_layer_norm, graph_outputs, section_padding_mask, layer_state
                 )
-
-                x = F.dropout(x, p=self.dropout, training=self.training)
-
-                if self.no_rezero:
-                    x = residual + x
-                else:
-                    x = residual + self.resweight * x
+                x = residual + (x if self.no_rezero else self.resweight * x)
                 if not self.normalize_before:
                     x = self.discourse_attn_layer_norm(x)
 
             if self.action_graph:
                 residual = x
-                assert self.action_attn.cache_key != self.self_attn.cache_key
-                if self.normalize_before:
-                    x = self.action_attn_layer_norm(x)
-
-                x, _ = self.action_attn(
-                    query=x,
-                    key=action_output,
-                    key_padding_mask=action_padding_mask,
-                    layer_state=layer_state,  # mutates layer state
+                x = self._graph_attn(
+                    x, self.action_attn, self.action_attn_layer_norm, action_output, action_padding_mask, layer_state
                 )
-
-                x = F.dropout(x, p=self.dropout, training=self.training)
-
-                if self.no_rezero:
-                    x = residual + x
-                else:
-                    x = residual + self.resweight_2 * x
+                x = residual + (x if self.no_rezero else self.resweight_2 * x)
                 if not self.normalize_before:
                     x = self.action_attn_layer_norm(x)
 
-        elif self.composit:
-            residual = x
-            action_x = x
-            discourse_x = x
+        else:
+            # Cross graph attention in parallel, merged by composit_layer
+            residual = action_x = discourse_x = x
             if self.action_graph:
-                # residual = x
-                assert self.action_attn.cache_key != self.self_attn.cache_key
-                if self.normalize_before:
-                    action_x = self.action_attn_layer_norm(action_x)
-
-                # print(graph_outputs.shape)
-                # print(action_output.shape, action_padding_mask.shape)
-                action_x, _ = self.action_attn(
-                    query=action_x,
-                    key=action_output,
-                    key_padding_mask=action_padding_mask,
-                    layer_state=layer_state,  # mutates layer state
+                action_x = self._graph_attn(
+                    x, self.action_attn, self.action_attn_layer_norm, action_output, action_padding_mask, layer_state
                 )
-
-                action_x = F.dropout(action_x, p=0.1, training=self.training)
-                # if not self.normalize_before:
-                #    action_x = self.action_attn_layer_norm(action_x)
-
             if self.discourse_graph:
-                assert self.discourse_attn.cache_key != self.self_attn.cache_key
-                if self.normalize_before:
-                    discourse_x = self.discourse_attn_layer_norm(discourse_x)
-
-                # print(graph_outputs.shape)
-                # print(graph_outputs.shape, section_padding_mask.shape)
-                discourse_x, _ = self.discourse_attn(
-                    query=discourse_x,
-                    key=graph_outputs,
-                    key_padding_mask=section_padding_mask,
-                    layer_state=layer_state,  # mutates layer state
+                discourse_x = self._graph_attn(
+                    x, self.discourse_attn, self.discourse_attn_layer_norm, graph_outputs, section_padding_mask, layer_state
                 )
 
-                discourse_x = F.dropout(discourse_x, p=0.1, training=self.training)
-                # x = residual + self.resweight * x
-                # if not self.normalize_before:
-                #    discourse_x = self.discourse_attn_layer_norm(discourse_x)
-
-            x = torch.cat([action_x, discourse_x], dim=-1)
-            x = self.composit_layer(x)
-            x = F.dropout(x, p=0.1, training=self.training)
-            if self.no_rezero:
-                x = residual + x
-            else:
-                x = residual + self.resweight * x
-            # x = residual +  x
-            if not self.normalize_before:
-                x = self.composit_layer_norm(x)
+            x = _dropout_add_layer_norm(
+                self._composit(action_x, discourse_x),
+                residual,
+                self.dropout,
+                self.training,
+                *_layer_norm_params(None if self.normalize_before else self.composit_layer_norm),
+                scale=None if self.no_rezero else self.resweight,
+            )
 
         # Fully Connected
         residual = x
         if self.normalize_before:
             x = self.final_layer_norm(x)
-        x = self.activation_fn(self.fc1(x))
+        x = self.activation_fn(self._fc1(x, decoding))
         x = F.dropout(x, p=self.activation_dropout, training=self.training)
-        x = self.fc2(x)
-        x = F.dropout(x, p=self.dropout, training=self.training)
-        x = residual + x
-        if not self.normalize_before:
-            x = self.final_layer_norm(x)
+        x = _dropout_add_layer_norm(
+            self.fc2(x),
+            residual,
+            self.dropout,
+            self.training,
+            *_layer_norm_params(None if self.normalize_before else self.final_layer_norm),
+        )
         return (
             x,
             self_attn_weights,
@@ -772,9 +948,27 @@ class BartDecoder(nn.Module):
         self.layers = nn.ModuleList(
             [DecoderLayer(config) for _ in range(config.decoder_layers)]
         )  # type: List[DecoderLayer]
+        if getattr(config, "use_torch_compile", False) and hasattr(torch, "compile"):
+            # identical layers share one compiled graph, dynamic since tgt_len/src_len change while generating
+            _compile_regions(self.layers)
+            self._decode_step = torch.compile(self._decode_step, dynamic=True)
         self.layernorm_embedding = LayerNorm(config.d_model) if config.normalize_embedding else nn.Identity()
         self.layer_norm = LayerNorm(config.d_model) if config.add_final_layer_norm else None
 
+    def _decode_step(self, x, encoder_hidden_states, past_key_values, layer_kwargs):
+        """All layers for one generation step: no LayerDrop draws and no hidden state or attention bookkeeping.
+
+        Each layer's cache dict is handed on as is instead of being shallow-copied every step. Attention updates
+        it (and appends to its key/value buffers) in place, which is fine because callers never keep the
+        per-layer dicts of an earlier step around.
+        """
+        next_decoder_cache = []
+        for idx, decoder_layer in enumerate(self.layers):
+            layer_state = past_key_values[idx] if past_key_values is not None else None
+            x, _, layer_past = decoder_layer(x, encoder_hidden_states, layer_state=layer_state, **layer_kwargs)
+            next_decoder_cache.append(layer_past)
+        return x, next_decoder_cache
+
     def forward(
             self,
             input_ids,
@@ -849,60 +1043,73 @@ class BartDecoder(nn.Module):
             input_ids = input_ids[:, -1:]
             positions = positions[:, -1:]
 
-        x = self.embed_tokens(input_ids) * self.embed_scale
+        # embed the transposed ids so x comes out contiguous in the (seq_len, BS, model_dim) layout of the layers
+        x = self.embed_tokens(input_ids.transpose(0, 1))
+        if self.embed_scale != 1.0:
+            x = x * self.embed_scale
+        if positions.dim() == 2:  # (seq_len, model_dim) -> (seq_len, 1, model_dim)
+            positions = positions.unsqueeze(1)
         x += positions
         x = self.layernorm_embedding(x)
         x = F.dropout(x, p=self.dropout, training=self.training)
 
-        # Convert to Bart output format: (seq_len, BS, model_dim) -> (BS, seq_len, model_dim)
-        x = x.transpose(0, 1)
-        encoder_hidden_states = encoder_hidden_states.transpose(0, 1)
+        # Convert the encoder side to the layers' format: (BS, seq_len, model_dim) -> (seq_len, BS, model_dim).
+        # Every layer projects keys/values from these, so without a cache they are made contiguous once here
+        # rather than copied inside each k_proj/v_proj; with a cache the static keys are not projected again.
+        to_layer_format = (lambda t: t.transpose(0, 1)) if past_key_values else (lambda t: t.transpose(0, 1).contiguous())
+        encoder_hidden_states = to_layer_format(encoder_hidden_states)
 
         if sent_outputs is not None:
-            sent_outputs = sent_outputs.transpose(0, 1)
+            sent_outputs = to_layer_format(sent_outputs)
 
         if graph_outputs is not None:
-            graph_outputs = graph_outputs.transpose(0, 1)
+            graph_outputs = to_layer_format(graph_outputs)
 
         if action_output is not None:
-            action_output = action_output.transpose(0, 1)
+            action_output = to_layer_format(action_output)
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         next_decoder_cache = []
-        for idx, decoder_layer in enumerate(self.layers):
+        layer_kwargs = dict(
+            encoder_attn_mask=encoder_padding_mask,
+            decoder_padding_mask=decoder_padding_mask,
+            causal_mask=decoder_causal_mask,
+            graph_outputs=graph_outputs,
+            section_padding_mask=section_padding_mask,
+            action_output=action_output,
+            action_padding_mask=action_padding_mask,
+            sent_outputs=sent_outputs,
+            sent_padding_mask=sent_padding_mask,
+        )
+        if use_cache and not (self.training or output_hidden_states or output_attentions):
+            # generation: the lean loop, compiled as a whole with --compile_layers
+            x, next_decoder_cache = self._decode_step(x, encoder_hidden_states, past_key_values, layer_kwargs)
+        else:
             # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
-            if output_hidden_states:
-                all_hidden_states += (x,)
-            dropout_probability = random.uniform(0, 1)
-            if self.training and (dropout_probability < self.layerdrop):
-                continue
+            if self.training and self.layerdrop > 0:
+                skip_layer = [random.uniform(0, 1) < self.layerdrop for _ in self.layers]
+            else:
+                skip_layer = [False] * len(self.layers)
+            for idx, (decoder_layer, skip) in enumerate(zip(self.layers, skip_layer)):
+                if output_hidden_states:
+                    all_hidden_states += (x,)
+                if skip:
+                    continue
 
-            layer_state = past_key_values[idx] if past_key_values is not None else None
+                layer_state = past_key_values[idx] if past_key_values is not None else None
 
-            # print(graph_outputs.shape)
-            # print(encoder_hidden_states.shape)
-            x, layer_self_attn, layer_past = decoder_layer(
-                x,
-                encoder_hidden_states,
-                encoder_attn_mask=encoder_padding_mask,
-                decoder_padding_mask=decoder_padding_mask,
-                layer_state=layer_state,
-                causal_mask=decoder_causal_mask,
-                output_attentions=output_attentions,
-                graph_outputs=graph_outputs,
-                section_padding_mask=section_padding_mask,
-                action_output=action_output,
-                action_padding_mask=action_padding_mask,
-                sent_outputs=sent_outputs,
-                sent_padding_mask=sent_padding_mask,
-            )
+                # print(graph_outputs.shape)
+                # print(encoder_hidden_states.shape)
+                x, layer_self_attn, layer_past = decoder_layer(
+                    x, encoder_hidden_states, layer_state=layer_state, output_attentions=output_attentions, **layer_kwargs
+                )
 
-            if use_cache:
-                next_decoder_cache.append(layer_past.copy())
+                if use_cache:
+                    next_decoder_cache.append(layer_past)
 
-            if output_attentions:
-                all_self_attns += (layer_self_attn,)
+                if output_attentions:
+                    all_self_attns += (layer_self_attn,)
 
         if self.layer_norm:  # if config.add_final_layer_norm (mBART)
             x = self.layer_norm(x)
@@ -911,7 +1118,6 @@ class BartDecoder(nn.Module):
         if output_hidden_states:
             all_hidden_states = tuple(hidden_state.transpose(0, 1) for hidden_state in all_hidden_states)
         x = x.transpose(0, 1)
-        encoder_hidden_states = encoder_hidden_states.transpose(0, 1)
 
         next_cache = next_decoder_cache if use_cache else None
 
@@ -924,7 +1130,7 @@ class BartDecoder(nn.Module):
 
 def _reorder_buffer(attn_cache, new_order):
     for k, input_buffer_k in attn_cache.items():
-        if input_buffer_k is not None:
+        if isinstance(input_buffer_k, Tensor):  # skips cache_len and empty masks
             attn_cache[k] = input_buffer_k.index_select(0, new_order)
     return attn_cache
 
@@ -974,10 +1180,30 @@ class Attention(nn.Module):
             self.cache_key = "self"
 
             # self.cache_key = "encoder_decoder" if self.encoder_decoder_attention else "self"
+        # keys/values come from the encoder side and are projected only once per generation
+        self.static_kv = (
+            encoder_decoder_attention or sent_decoder_attention or graph_decoder_attention or action_decoder_attention
+        )
 
     def _shape(self, tensor, seq_len, bsz):
         return tensor.contiguous().view(seq_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
 
+    def varlen_forward(self, x, cu_seqlens, max_seqlen):
+        """Self-attention over packed sequences `(total_tokens, embed_dim)` with FlashAttention, no padding."""
+        q, k, v = (proj(x).view(-1, self.num_heads, self.head_dim) for proj in (self.q_proj, self.k_proj, self.v_proj))
+        attn_output = flash_attn_varlen_func(
+            q,
+            k,
+            v,
+            cu_seqlens,
+            cu_seqlens,
+            max_seqlen,
+            max_seqlen,
+            dropout_p=self.dropout if self.training else 0.0,
+            softmax_scale=self.scaling,
+        )
+        return self.out_proj(attn_output.reshape(-1, self.embed_dim))
+
     def forward(
             self,
             query,
@@ -988,25 +1214,28 @@ class Attention(nn.Module):
             output_attentions=False,
     ) -> Tuple[Tensor, Optional[Tensor]]:
         """Input shape: Time(SeqLen) x Batch x Channel"""
-        static_kv: bool = self.encoder_decoder_attention or self.graph_decoder_attention or self.action_decoder_attention or self.sent_decoder_attention
+        static_kv: bool = self.static_kv
         tgt_len, bsz, embed_dim = query.size()
         assert embed_dim == self.embed_dim
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
         # print('cache_key1', self.cache_key)
         # get here for encoder decoder cause of static_kv
+        reuse_static = False
         if layer_state is not None:  # reuse k,v and encoder_padding_mask
             saved_state = layer_state.get(self.cache_key, {})
             # print('cache_key2', self.cache_key)
-            
+
             if "prev_key" in saved_state and static_kv:
                 # previous time steps are cached - no need to recompute key and value if they are static
                 key = None
+                reuse_static = True
         else:
             saved_state = None
             layer_state = {}
 
-        q = self.q_proj(query) * self.scaling
-        
+        # F.scaled_dot_product_attention applies the same head_dim ** -0.5 scaling itself
+        use_sdpa = SDPA_AVAILABLE and not output_attentions
+        q = self.q_proj(query)
         if static_kv:
             if key is None:
                 k = v = None
@@ -1016,6 +1245,8 @@ class Attention(nn.Module):
         else:
             k = self.k_proj(query)
             v = self.v_proj(query)
+        if not use_sdpa:
+            q = q * self.scaling
 
         q = self._shape(q, tgt_len, bsz)
 
@@ -1027,22 +1258,28 @@ class Attention(nn.Module):
             v = self._shape(v, -1, bsz)
 
         # print("k2", k.shape)
+        cache = None
         if saved_state is not None:
             # print(k, v)
-            k, v, key_padding_mask = self._use_saved_state(k, v, saved_state, key_padding_mask, static_kv, bsz)
+            k, v, key_padding_mask, cache = self._use_saved_state(
+                k, v, saved_state, key_padding_mask, static_kv, bsz
+            )
 
-        # Update cache
-        layer_state[self.cache_key] = {
-            "prev_key": k.view(bsz, self.num_heads, -1, self.head_dim),
-            "prev_value": v.view(bsz, self.num_heads, -1, self.head_dim),
-            "prev_key_padding_mask": key_padding_mask if not static_kv else None,
-        }
+        # Update cache; a reused static entry is already in layer_state unchanged
+        if not reuse_static:
+            layer_state[self.cache_key] = cache if cache is not None else {
+                "prev_key": k.view(bsz, self.num_heads, -1, self.head_dim),
+                "prev_value": v.view(bsz, self.num_heads, -1, self.head_dim),
+                "prev_key_padding_mask": key_padding_mask if not static_kv else None,
+            }
 
         assert k is not None
 
         # print("k", k.shape)
 
         src_len = k.size(1)
+        if use_sdpa:
+            return self._sdpa_forward(q, k, v, key_padding_mask, attn_mask, tgt_len, bsz), None
         attn_weights = torch.bmm(q, k.transpose(1, 2))
         assert attn_weights.size() == (bsz * self.num_heads, tgt_len, src_len)
 
@@ -1064,14 +1301,17 @@ class Attention(nn.Module):
         #     print(key_padding_mask.shape)
         # print(bsz, src_len)
         # print(None.shape)
-        assert key_padding_mask is None or key_padding_mask.size()[:2] == (
+        assert key_padding_mask is None or (key_padding_mask.size(0), key_padding_mask.size(-1)) == (
             bsz,
             src_len,
         )
 
         if key_padding_mask is not None:  # don't attend to padding symbols
             attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            reshaped = key_padding_mask.unsqueeze(1).unsqueeze(2)
+            if key_padding_mask.dim() == 4:  # already (bsz, 1, 1, src_len), see BartEncoder.forward
+                reshaped = key_padding_mask
+            else:
+                reshaped = key_padding_mask.unsqueeze(1).unsqueeze(2)
             attn_weights = attn_weights.masked_fill(reshaped, float("-inf"))
             attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
         attn_weights = F.softmax(attn_weights, dim=-1)
@@ -1092,13 +1332,76 @@ class Attention(nn.Module):
             attn_weights = None
         return attn_output, attn_weights
 
+    def _sdpa_forward(self, q, k, v, key_padding_mask, attn_mask, tgt_len, bsz):
+        """Fused attention through F.scaled_dot_product_attention, never materializing the `(tgt, src)` scores."""
+        mask = None
+        is_causal = False
+        if attn_mask is not None and key_padding_mask is None and q.size(1) == k.size(1):
+            # the only attn_mask in bart is the decoder's causal triangle; without padding, is_causal lets
+            # SDPA pick the FlashAttention kernel, which does not take an explicit mask
+            is_causal, attn_mask = True, None
+        if key_padding_mask is not None:
+            if key_padding_mask.dim() != 4:
+                key_padding_mask = key_padding_mask.unsqueeze(1).unsqueeze(2)
+            key_padding_mask = key_padding_mask.bool()
+            if attn_mask is not None:
+                mask = torch.where(key_padding_mask, attn_mask.new_full((), float("-inf")), attn_mask)
+            else:
+                mask = ~key_padding_mask  # boolean masks mark the positions that may be attended
+        elif attn_mask is not None:
+            mask = attn_mask
+        attn_output = F.scaled_dot_product_attention(
+            q.view(bsz, self.num_heads, tgt_len, self.head_dim),
+            k.view(bsz, self.num_heads, -1, self.head_dim),
+            v.view(bsz, self.num_heads, -1, self.head_dim),
+            attn_mask=mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            is_causal=is_causal,
+        )
+        attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, self.embed_dim)
+        return self.out_proj(attn_output)
+
+    def _append_to_buffer(self, saved_state, name, new, bsz):
+        """Write ``new`` after the cached positions of ``saved_state[name]``, growing the buffer by doubling."""
+        buffer = saved_state[name]
+        cache_len = saved_state.get("cache_len", buffer.size(2))  # a plain prev_key from the first step is full
+        new = new.view(bsz, self.num_heads, -1, self.head_dim)
+        new_len = cache_len + new.size(2)
+        if "cache_len" not in saved_state or new_len > buffer.size(2):
+            grown = buffer.new_empty(bsz, self.num_heads, max(2 * new_len, 16), self.head_dim)
+            grown[:, :, :cache_len] = buffer[:, :, :cache_len]
+            buffer = grown
+        buffer[:, :, cache_len:new_len] = new
+        return buffer, new_len
+
     def _use_saved_state(self, k, v, saved_state, key_padding_mask, static_kv, bsz):
         # saved states are stored with shape (bsz, num_heads, seq_len, head_dim)
+        if not static_kv and "prev_key" in saved_state and not torch.is_grad_enabled():
+            # incremental decoding: append the new step to preallocated buffers instead of concatenating the
+            # whole history again; the buffers only hold cache_len valid positions
+            assert k is not None and v is not None
+            key_buffer, cache_len = self._append_to_buffer(saved_state, "prev_key", k, bsz)
+            value_buffer, _ = self._append_to_buffer(saved_state, "prev_value", v, bsz)
+            prev_key_padding_mask = saved_state.get("prev_key_padding_mask", None)
+            if prev_key_padding_mask is not None:
+                key_padding_mask = torch.cat([prev_key_padding_mask, key_padding_mask], dim=1)
+            cache = {
+                "prev_key": key_buffer,
+                "prev_value": value_buffer,
+                "prev_key_padding_mask": key_padding_mask,
+                "cache_len": cache_len,
+            }
+            k = key_buffer[:, :, :cache_len].view(bsz * self.num_heads, cache_len, self.head_dim)
+            v = value_buffer[:, :, :cache_len].view(bsz * self.num_heads, cache_len, self.head_dim)
+            return k, v, key_padding_mask, cache
+        # a buffer grown above only holds cache_len valid positions; drop the spare capacity when falling back
+        cache_len = saved_state.get("cache_len", None)
         if "prev_key" in saved_state:
             _prev_key = saved_state["prev_key"]
             assert _prev_key is not None
-
-            prev_key = _prev_key.view(bsz * self.num_heads, -1, self.head_dim)
+            if cache_len is not None:
+                _prev_key = _prev_key[:, :, :cache_len]
+            prev_key = _prev_key.reshape(bsz * self.num_heads, -1, self.head_dim)
             if static_kv:
                 k = prev_key
             else:
@@ -1107,7 +1410,9 @@ class Attention(nn.Module):
         if "prev_value" in saved_state:
             _prev_value = saved_state["prev_value"]
             assert _prev_value is not None
-            prev_value = _prev_value.view(bsz * self.num_heads, -1, self.head_dim)
+            if cache_len is not None:
+                _prev_value = _prev_value[:, :, :cache_len]
+            prev_value = _prev_value.reshape(bsz * self.num_heads, -1, self.head_dim)
             if static_kv:
                 v = prev_value
             else:
@@ -1122,7 +1427,7 @@ class Attention(nn.Module):
                 new_key_padding_mask = torch.cat([prev_key_padding_mask, key_padding_mask], dim=1)
         else:
             new_key_padding_mask = key_padding_mask
-        return k, v, new_key_padding_mask
+        return k, v, new_key_padding_mask, None
 
 
 class BartClassificationHead(nn.Module):
@@ -1170,23 +1475,29 @@ class LearnedPositionalEmbedding(nn.Embedding):
     def forward(self, input_ids, use_cache=False):
         """Input is expected to be of size [bsz x seqlen]."""
         bsz, seq_len = input_ids.shape[:2]
+        # positions are always contiguous, so the lookup of arange(...) + offset is just a slice of the table
         if use_cache:
-            positions = input_ids.data.new(1, 1).fill_(seq_len - 1)  # called before slicing
-        else:
-            # starts at 0, ends at 1-seq_len
-            positions = torch.arange(seq_len, dtype=torch.long, device=self.weight.device)
-        return super().forward(positions + self.offset)
+            # called before slicing, only the newest position is needed
+            return self.weight[self.offset + seq_len - 1].view(1, 1, -1)
+        # starts at 0, ends at 1-seq_len
+        return self.weight[self.offset : self.offset + seq_len]
 
 
-def LayerNorm(normalized_shape, eps=1e-5, elementwise_affine=True):
-    if torch.cuda.is_available():
-        try:
-            from apex.normalization import FusedLayerNorm
+# resolved once at import instead of retrying the apex import for every LayerNorm that is built
+have_fused_layer_norm = False
+if torch.cuda.is_available():
+    try:
+        from apex.normalization import FusedLayerNorm
 
-            return FusedLayerNorm(normalized_shape, eps, elementwise_affine)
-        except ImportError:
-            pass
-    return torch.nn.LayerNorm(normalized_shape, eps, elementwise_affine)
+        have_fused_layer_norm = True
+    except ImportError:
+        pass
+
+_LayerNorm = FusedLayerNorm if have_fused_layer_norm else torch.nn.LayerNorm
+
+
+def LayerNorm(normalized_shape, eps=1e-5, elementwise_affine=True):
+    return _LayerNorm(normalized_shape, eps, elementwise_affine)
 
 
 def fill_with_neg_inf(t):
@@ -1228,35 +1539,42 @@ class GraphAttentionLayer(nn.Module):
         self.leakyrelu = nn.LeakyReLU(self.alpha)
         self.layer_norm = LayerNorm(out_features)
 
-    def forward(self, h, adj, relation=False):
+    def forward(self, h, adj, relation=False, adj_mask=None, long_adj=None):
+        """``adj_mask`` (``adj <= 0``) and ``long_adj`` (``adj.long()``) can be passed in when several layers share
+        ``adj``, so they are built once per graph instead of once per layer."""
+        if adj_mask is None:
+            adj_mask = adj <= 0
+        if long_adj is None and self.relation:
+            long_adj = adj.long()
         # Wh = torch.mm(h, self.W) # h.shape: (N, in_features), Wh.shape: (N, out_features)
         # print('h', h.shape)
         # print('W', self.W.shape)
         Wh = torch.matmul(h, self.W)  # b,N, N_out_features
 
-        a_input = self._prepare_attentional_mechanism_input(Wh)
+        # [Wh_i || Wh_j] @ a splits into Wh_i @ a_src + Wh_j @ a_dst, so the (B, N, N, 2 * out_features)
+        # all-pairs input never needs to be built: broadcast a (B, N, 1) and a (B, 1, N) score instead
+        a_src = self.a[: self.out_features]
+        a_dst = self.a[self.out_features : 2 * self.out_features]
+        e = torch.matmul(Wh, a_src) + torch.matmul(Wh, a_dst).transpose(1, 2)  # B, N, N
 
         if self.relation:
-            long_adj = adj.clone().type(torch.LongTensor).cuda()
-            relation_one_hot = self.one_hot_embedding(long_adj)
-
-            # print(relation_one_hot.shape)
-
-            a_input = torch.cat([a_input, relation_one_hot], dim=-1)
-
-        # print(a_input.shape)
+            # one_hot_embedding(adj) @ a_rel is a lookup in one_hot_embedding.weight @ a_rel; the table is not the
+            # identity it starts as, since _init_weights re-initializes every nn.Embedding
+            relation_scores = torch.matmul(self.one_hot_embedding.weight, self.a[2 * self.out_features :])
+            e = e + F.embedding(long_adj, relation_scores).squeeze(-1)
 
-        e = self.leakyrelu(torch.matmul(a_input, self.a).squeeze(3))  # B, N , N
+        e = self.leakyrelu(e)
 
-        zero_vec = -9e15 * torch.ones_like(e)
-        # print(adj.shape)
-        # print(e.shape)
         # TODO: Solve empty graph issue here!
-        attention = torch.where(adj > 0, e, zero_vec)
+        # masked in place with the dtype's lowest finite value (-9e15 overflows half under fp16 autocast), so a node
+        # without neighbours still gets a uniform (not NaN) row
+        attention = e.masked_fill_(adj_mask, torch.finfo(e.dtype).min)
         attention = F.softmax(attention, dim=2)  # B, N, N
         attention = F.dropout(attention, self.dropout, training=self.training)
         h_prime = torch.matmul(attention, Wh)
 
+        if h_prime.dtype == torch.bfloat16:  # under GAT's bf16 autocast; the (possibly fused) LayerNorm runs in fp32
+            h_prime = h_prime.float()
         h_prime = self.layer_norm(h_prime)
         # B, N, N_OUT_FEATURES
 
@@ -1265,47 +1583,6 @@ class GraphAttentionLayer(nn.Module):
         else:
             return h_prime
 
-    def _prepare_attentional_mechanism_input(self, Wh):
-        N = Wh.size()[1]  # number of nodes
-        B = Wh.size()[0]  # number of batches
-        # Below, two matrices are created that contain embeddings in their rows in different orders.
-        # (e stands for embedding)
-        # These are the rows of the first matrix (Wh_repeated_in_chunks): 
-        # e1, e1, ..., e1,            e2, e2, ..., e2,            ..., eN, eN, ..., eN
-        # '-------------' -> N times  '-------------' -> N times       '-------------' -> N times
-        # 
-        # These are the rows of the second matrix (Wh_repeated_alternating): 
-        # e1, e2, ..., eN, e1, e2, ..., eN, ..., e1, e2, ..., eN 
-        # '----------------------------------------------------' -> N times
-        # 
-        # print('Wh', Wh.shape)
-        Wh_repeated_in_chunks = Wh.repeat_interleave(N, dim=1)
-        Wh_repeated_alternating = Wh.repeat(1, N, 1)
-        # Wh_repeated_in_chunks.shape == Wh_repeated_alternating.shape == (N * N, out_features)
-
-        # The all_combination_matrix, created below, will look like this (|| denotes concatenation):
-        # e1 || e1
-        # e1 || e2
-        # e1 || e3
-        # ...
-        # e1 || eN
-        # e2 || e1
-        # e2 || e2
-        # e2 || e3
-        # ...
-        # e2 || eN
-        # ...
-        # eN || e1
-        # eN || e2
-        # eN || e3
-        # ...
-        # eN || eN
-
-        all_combinations_matrix = torch.cat([Wh_repeated_in_chunks, Wh_repeated_alternating], dim=2)
-        # all_combinations_matrix.shape == (B, N * N, 2 * out_features)
-
-        return all_combinations_matrix.view(B, N, N, 2 * self.out_features)
-
     def __repr__(self):
         return self.__class__.__name__ + ' (' + str(self.in_features) + ' -> ' + str(self.out_features) + ')'
 
@@ -1330,13 +1607,65 @@ class GAT(nn.Module):
 
         self.fc = nn.Linear(nhid, nhid)
         self.layer_norm = LayerNorm(nhid)
+        # bf16 autocast for the GAT matmuls (--gat_bf16); needs torch.autocast (torch>=1.10)
+        self.bf16 = getattr(config, "gat_bf16", False) and hasattr(torch, "autocast")
+        if getattr(config, "use_torch_compile", False) and hasattr(torch, "compile"):
+            _compile_regions([self])
+
+    def _heads_forward(self, h, adj_mask, long_adj):
+        """All ``self.attentions`` heads at once, equal to ``torch.cat([att(h, adj) for att in heads], -1)``.
+
+        The per-head parameters are stacked so every step runs as one batched kernel over a head dim, instead of
+        one kernel sequence per head; the modules themselves, and so the checkpoint keys, stay per head.
+        """
+        heads = self.attentions
+        out_features = heads[0].out_features
+        a = torch.stack([att.a for att in heads]).squeeze(-1)  # H, 2 * out_features (+ 18)
+        Wh = torch.matmul(h.unsqueeze(1), torch.stack([att.W for att in heads]))  # B, H, N, out_features
+
+        e = torch.matmul(Wh, a[:, :out_features, None]) + torch.matmul(
+            Wh, a[:, out_features : 2 * out_features, None]
+        ).transpose(2, 3)  # B, H, N, N
+        if self.relation:
+            # each head's relation vector goes through its own one_hot_embedding table, as in GraphAttentionLayer
+            relation_scores = torch.stack(
+                [torch.matmul(att.one_hot_embedding.weight, att.a[2 * out_features :]) for att in heads]
+            )  # H, 18, 1
+            e = e + F.embedding(long_adj, relation_scores.squeeze(-1).t()).permute(0, 3, 1, 2)
+        e = F.leaky_relu(e, heads[0].alpha)
+
+        # TODO: Solve empty graph issue here!
+        attention = e.masked_fill_(adj_mask.unsqueeze(1), torch.finfo(e.dtype).min)
+        attention = F.softmax(attention, dim=-1)
+        attention = F.dropout(attention, heads[0].dropout, training=self.training)
+        h_prime = torch.matmul(attention, Wh)  # B, H, N, out_features
+
+        # each head normalizes with its own LayerNorm affine
+        h_prime = F.layer_norm(h_prime, (out_features,), eps=heads[0].layer_norm.eps)
+        weight = torch.stack([att.layer_norm.weight for att in heads])[:, None, :]
+        bias = torch.stack([att.layer_norm.bias for att in heads])[:, None, :]
+        h_prime = torch.addcmul(bias, h_prime, weight)
+        if heads[0].concat:
+            h_prime = F.gelu(h_prime)
+        return h_prime.transpose(1, 2).reshape(h.size(0), h.size(1), len(heads) * out_features)
 
     def forward(self, x, adj, relation=False):
+        if self.bf16 and x.is_cuda and not torch.is_autocast_enabled():
+            # the h @ W, score and attention @ Wh matmuls run in bf16; autocast keeps softmax and the
+            # LayerNorms in fp32, and the fp32 residual brings the output back to fp32
+            with torch.autocast("cuda", dtype=torch.bfloat16):
+                return self._forward(x, adj)
+        return self._forward(x, adj)
+
+    def _forward(self, x, adj):
         redisual = x
+        # shared by the heads and out_att
+        adj_mask = adj <= 0
+        long_adj = adj.long() if self.relation else None
         x = F.dropout(x, self.dropout, training=self.training)
-        x = torch.cat([att(x, adj) for att in self.attentions], dim=-1)
+        x = self._heads_forward(x, adj_mask, long_adj)
         x = F.dropout(x, self.dropout, training=self.training)
-        x = F.gelu(self.out_att(x, adj))
+        x = F.gelu(self.out_att(x, adj, adj_mask=adj_mask, long_adj=long_adj))
         x = self.fc(x)
         x = x + redisual
         x = self.layer_norm(x)
@@ -1394,6 +1723,10 @@ class BartModel(PretrainedBartModel):
 
         self.encoder = BartEncoder(config, self.shared)
         self.decoder = BartDecoder(config, self.shared)
+        # built once and sliced per forward, follows the model across .to()/.half() but is not checkpointed
+        self.register_buffer(
+            "causal_mask", _make_causal_mask(config.max_position_embeddings), persistent=False
+        )
 
 
         if config.discourse_graph:
@@ -1416,59 +1749,18 @@ class BartModel(PretrainedBartModel):
                       output_hidden_states=False,
                       return_dict=False, ):
 
-        if not self.config.only_embedding:
-            action_outputs = self.encoder(
-                input_ids=actions,
-                attention_mask=actions_mask, output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-            )
-
-            node_representations = action_outputs[0]
-
-            nodes = [
-                torch.tensor(torch.zeros([action_adj.shape[1], node_representations.shape[-1]]), requires_grad=True).to(
-                    node_representations.device)]
-
-            for i in range(0, actions.shape[0]):
-                # print(input_ids[i])
-                segs = actions[i].eq(0)
-                # print(segs)
-                nodes.append(node_representations[i][segs])
-
-        else:
-            # print('actions', actions.shape)
-            action_outputs = self.encoder(
-                input_ids=actions,
-                attention_mask=actions_mask, output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-                segmented_encoder=True,
-            )
-
-            node_representations = action_outputs[0]
-
-            nodes = [
-                torch.tensor(torch.zeros([action_adj.shape[1], node_representations.shape[-1]]), requires_grad=True).to(
-                    node_representations.device)]
-
-            for i in range(0, actions.shape[0]):
-                # print(input_ids[i])
-                segs = actions[i].eq(0)
-                # print(segs)
-                nodes.append(node_representations[i][segs])
-
-        nodes = pad_sequence(nodes)
+        action_outputs = self.encoder(
+            input_ids=actions,
+            attention_mask=actions_mask, output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+            segmented_encoder=self.config.only_embedding,
+        )
 
-        # print(nodes.shape)
+        node_representations = action_outputs[0]
 
-        nodes = nodes[:, 1:, :]
-        # N * B * hid
-        nodes = nodes.transpose(1, 0)
-        # print(sections.shape)
-        # B * N * hid
-        nodes_padding = nodes.eq(0).sum(-1) > 0
-        nodes_padding_mask = 1 - nodes_padding.type(torch.long)
+        # B * N * hid, one node per action
+        nodes, nodes_padding_mask = _gather_segments(node_representations, actions, action_adj.size(1))
 
         graph_outputs = self.action_encoder(nodes, action_adj)
         # B * N * hid
@@ -1479,26 +1771,8 @@ class BartModel(PretrainedBartModel):
     def encode_graph(self, utterance_representations, adj, input_ids, relation=False):
         # print('adj', adj.shape)
         # print('utterance_representations', utterance_representations.shape)
-        sections = [
-            torch.tensor(torch.zeros([adj.shape[1], utterance_representations.shape[-1]]), requires_grad=True).to(
-                utterance_representations.device)]
-        # print('input_ids', input_ids.shape)
-        for i in range(0, input_ids.shape[0]):
-            # print(input_ids[i])
-            segs = input_ids[i].eq(0)
-            # print(segs)
-            sections.append(utterance_representations[i][segs])
-
-        sections = pad_sequence(sections)
-
-        sections = sections[:, 1:, :]
-        # N * B * hid
-        sections = sections.transpose(1, 0)
-        # print(sections.shape)
-        # B * N * hid
-
-        section_padding = sections.eq(0).sum(-1) > 0
-        section_padding_mask = 1 - section_padding.type(torch.long)
+        # B * N * hid, one section per utterance, as many slots as the graph has nodes
+        sections, section_padding_mask = _gather_segments(utterance_representations, input_ids, adj.size(1))
 
         graph_outputs = self.discourse_encoder(sections, adj, relation)
         # B * N * hid
@@ -1510,24 +1784,9 @@ class BartModel(PretrainedBartModel):
                     segmented_encoder=False, return_dict=False):
         # print('adj', adj.shape)
         # print('utterance_representations', utterance_representations.shape)
-        sections = []
-        # print('input_ids', input_ids.shape)
-        for i in range(0, input_ids.shape[0]):
-            # print(input_ids[i])
-            segs = input_ids[i].eq(0)
-            # print(segs)
-            sections.append(utterance_representations[i][segs])
-
-        sections = pad_sequence(sections)
-
-        # sections = sections[:, 1:, :]
-        # N * B * hid
-        sections = sections.transpose(1, 0)
-        # print(sections.shape)
-        # B * N * hid
-
-        section_padding = sections.eq(0).sum(-1) > 0
-        sent_padding_mask = 1 - section_padding.type(torch.long)
+        # B * N * hid, the mask comes from the utterance counts rather than from scanning for all-zero rows;
+        # N is a multiple of 8 so the sentence encoder GEMMs stay tensor core aligned
+        sections, sent_padding_mask = _gather_segments(utterance_representations, input_ids, pad_to_multiple_of=8)
 
         sent_outputs = self.encoder(
             input_ids=sections,
@@ -1598,6 +1857,7 @@ class BartModel(PretrainedBartModel):
                 decoder_input_ids=decoder_input_ids,
                 decoder_padding_mask=decoder_attention_mask,
                 causal_mask_dtype=self.shared.weight.dtype,
+                causal_mask=self.causal_mask,
             )
         else:
             decoder_padding_mask, causal_mask = None, None
@@ -1652,42 +1912,24 @@ class BartModel(PretrainedBartModel):
         # print('graph_outputs:', graph_outputs.shape)
         # print(action_output.shape, action_padding_mask.shape)
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
-        if not sent_encoder:
-            decoder_outputs = self.decoder(
-                decoder_input_ids,
-                encoder_outputs[0],
-                attention_mask,
-                decoder_padding_mask,
-                decoder_causal_mask=causal_mask,
-                past_key_values=past_key_values,
-                use_cache=use_cache,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-                graph_outputs=graph_outputs,
-                section_padding_mask=section_padding_mask,
-                action_output=action_output,
-                action_padding_mask=action_padding_mask,
-            )
-        else:
-            decoder_outputs = self.decoder(
-                decoder_input_ids,
-                encoder_outputs[0],
-                attention_mask,
-                decoder_padding_mask,
-                decoder_causal_mask=causal_mask,
-                past_key_values=past_key_values,
-                use_cache=use_cache,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-                graph_outputs=graph_outputs,
-                section_padding_mask=section_padding_mask,
-                action_output=action_output,
-                action_padding_mask=action_padding_mask,
-                sent_outputs=sent_outputs[0],
-                sent_padding_mask=sent_padding_mask,
-            )
+        decoder_outputs = self.decoder(
+            decoder_input_ids,
+            encoder_outputs[0],
+            attention_mask,
+            decoder_padding_mask,
+            decoder_causal_mask=causal_mask,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+            graph_outputs=graph_outputs,
+            section_padding_mask=section_padding_mask,
+            action_output=action_output,
+            action_padding_mask=action_padding_mask,
+            sent_outputs=sent_outputs[0] if sent_encoder else None,
+            sent_padding_mask=sent_padding_mask if sent_encoder else None,
+        )
 
         if not return_dict:
             return decoder_outputs + encoder_outputs
@@ -1709,9 +1951,15 @@ class BartModel(PretrainedBartModel):
         self.shared = value
         self.encoder.embed_tokens = self.shared
         self.decoder.embed_tokens = self.shared
+        self._output_embeddings_cache = None
 
     def get_output_embeddings(self):
-        return _make_linear_from_emb(self.shared)  # make it on the fly
+        # made on first use and reused while it still shares self.shared's weight; kept in a tuple so the Linear is
+        # not registered as a submodule (and so not saved in the state dict)
+        cache = getattr(self, "_output_embeddings_cache", None)
+        if cache is None or cache[0] is not self.shared or cache[1].weight.data_ptr() != self.shared.weight.data_ptr():
+            cache = self._output_embeddings_cache = (self.shared, _make_linear_from_emb(self.shared))
+        return cache[1]
 
 
 @add_start_docstrings(
@@ -1726,6 +1974,64 @@ class BartForConditionalGeneration(PretrainedBartModel):
         base_model = BartModel(config)
         self.model = base_model
         self.register_buffer("final_logits_bias", torch.zeros((1, self.model.shared.num_embeddings)))
+        # logits buffer for cached decoding steps, see _lm_head
+        self._scratch_logits = None
+        # the source mask generate() hands to every step, see prepare_inputs_for_generation
+        self._generation_attention_mask = None
+
+    def _lm_head(self, x, decoding):
+        """The tied vocabulary projection. On cached decoding steps without autograd it writes into a buffer reused
+        across steps, so the returned logits are only valid until the next such call (``generate`` reads them once).
+        """
+        if not decoding or torch.is_grad_enabled() or torch.is_autocast_enabled():
+            return F.linear(x, self.model.shared.weight, bias=self.final_logits_bias)
+        weight = self.model.shared.weight
+        shape = x.shape[:-1] + (weight.size(0),)
+        scratch = self._scratch_logits
+        if scratch is None or scratch.shape != shape or scratch.dtype != x.dtype or scratch.device != x.device:
+            scratch = self._scratch_logits = _decoding_scratch(x, shape)
+        torch.addmm(self.final_logits_bias, x.reshape(-1, x.size(-1)), weight.t(), out=scratch.view(-1, shape[-1]))
+        return scratch
+
+    def generate(self, *args, **kwargs):
+        """:meth:`~transformers.generation_utils.GenerationMixin.generate`, releasing the decoding buffers (see
+        :meth:`_lm_head` and ``DecoderLayer._fc1``) once it returns."""
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            self._release_decoding_buffers()
+
+    def _release_decoding_buffers(self):
+        self._scratch_logits = None
+        self._generation_attention_mask = None
+        for layer in self.model.decoder.layers:
+            layer._scratch_fc1 = None
+
+    def _decode_step(self, decoder_input_ids, encoder_outputs, attention_mask, past_key_values, **side_outputs):
+        """One cached generation step straight through the decoder and LM head, what :meth:`forward` does for it
+        without the encoder side bookkeeping of ``BartModel.forward``."""
+        decoder_outputs = self.model.decoder(
+            decoder_input_ids,
+            encoder_outputs.last_hidden_state,
+            attention_mask,  # already None without padding, see prepare_inputs_for_generation
+            None,
+            decoder_causal_mask=None,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+            **side_outputs,
+        )
+        if getattr(self, "_quantized_lm_head", None) is not None and not self.training:
+            lm_logits = self._quantized_lm_head[0](decoder_outputs.last_hidden_state)
+        else:
+            lm_logits = self._lm_head(decoder_outputs.last_hidden_state, decoding=True)
+        return Seq2SeqLMOutput(
+            logits=lm_logits,
+            past_key_values=decoder_outputs.past_key_values,
+            encoder_last_hidden_state=encoder_outputs.last_hidden_state,
+            encoder_hidden_states=encoder_outputs.hidden_states,
+            encoder_attentions=encoder_outputs.attentions,
+        )
 
     def resize_token_embeddings(self, new_num_tokens: int) -> nn.Embedding:
         old_num_tokens = self.model.shared.num_embeddings
@@ -1741,6 +2047,21 @@ class BartForConditionalGeneration(PretrainedBartModel):
             extra_bias = torch.zeros((1, new_num_tokens - old_num_tokens), device=self.final_logits_bias.device)
             new_bias = torch.cat([self.final_logits_bias, extra_bias], dim=1)
         self.register_buffer("final_logits_bias", new_bias)
+        self._quantized_lm_head = None
+
+    def quantize_lm_head_(self):
+        """Use an int8 dynamically quantized copy of the tied LM head (``shared.weight`` and ``final_logits_bias``).
+
+        Like :meth:`quantize_ffn_`, meant for CPU inference once the weights are loaded. The embedding itself stays
+        in full precision and the copy is not part of the state dict; it is only used outside training.
+        """
+        lm_head = nn.Linear(self.config.d_model, self.model.shared.num_embeddings)
+        lm_head.weight = self.model.shared.weight
+        lm_head.bias = nn.Parameter(self.final_logits_bias.detach().view(-1).clone(), requires_grad=False)
+        quantized = torch.quantization.quantize_dynamic(nn.Sequential(lm_head), {nn.Linear}, dtype=torch.qint8)
+        # a tuple, so the quantized module is not registered as a submodule
+        self._quantized_lm_head = (quantized[0],)
+        return self
 
     @add_start_docstrings_to_callable(BART_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=Seq2SeqLMOutput, config_class=_CONFIG_FOR_DOC)
@@ -1825,6 +2146,31 @@ class BartForConditionalGeneration(PretrainedBartModel):
             use_cache = False
             if decoder_input_ids is None:
                 decoder_input_ids = shift_tokens_right(labels, self.config.pad_token_id)
+        elif (
+            return_dict
+            and past_key_values is not None
+            and decoder_input_ids is not None
+            and isinstance(encoder_outputs, BaseModelOutput)
+            and (use_cache if use_cache is not None else self.config.use_cache)
+            and not (output_attentions if output_attentions is not None else self.config.output_attentions)
+            and not (output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states)
+            and (graph_outputs is not None or not discourse_graph)
+            and (sent_outputs is not None or not sent_encoder)
+            and (action_output is not None or not self.config.action_graph)
+        ):
+            # a cached generation step with every encoder side output precomputed
+            return self._decode_step(
+                decoder_input_ids,
+                encoder_outputs,
+                attention_mask,
+                past_key_values,
+                graph_outputs=graph_outputs,
+                section_padding_mask=section_padding_mask,
+                action_output=action_output,
+                action_padding_mask=action_padding_mask,
+                sent_outputs=sent_outputs[0] if sent_encoder else None,
+                sent_padding_mask=sent_padding_mask if sent_encoder else None,
+            )
         outputs = self.model(
             input_ids,
             attention_mask=attention_mask,
@@ -1851,10 +2197,18 @@ class BartForConditionalGeneration(PretrainedBartModel):
             sent_outputs=sent_outputs,
             sent_padding_mask=sent_padding_mask,
         )
-        lm_logits = F.linear(outputs[0], self.model.shared.weight, bias=self.final_logits_bias)
-
         masked_lm_loss = None
-        if labels is not None:
+        if labels is not None and getattr(self.config, "fused_lm_loss", False):
+            # training loss only: the (B, T, vocab_size) logits are never materialized, so none are returned
+            lm_logits = None
+            masked_lm_loss = fused_linear_cross_entropy(
+                outputs[0], self.model.shared.weight, self.final_logits_bias, labels
+            )
+        elif getattr(self, "_quantized_lm_head", None) is not None and not self.training:
+            lm_logits = self._quantized_lm_head[0](outputs[0])
+        else:
+            lm_logits = self._lm_head(outputs[0], decoding=past_key_values is not None)
+        if labels is not None and lm_logits is not None:
             loss_fct = CrossEntropyLoss()
             # TODO(SS): do we need to ignore pad tokens in labels?
             masked_lm_loss = loss_fct(lm_logits.view(-1, self.config.vocab_size), labels.view(-1))
@@ -1877,12 +2231,16 @@ class BartForConditionalGeneration(PretrainedBartModel):
     def prepare_inputs_for_generation(
             self, decoder_input_ids, past, attention_mask, use_cache, encoder_outputs, **kwargs
     ):
+        if past is None:
+            # the source mask is fixed for the whole generate call, so whether it masks anything is decided once,
+            # on the first step, instead of syncing with the device on every generated token
+            self._generation_attention_mask = _drop_unpadded_mask(attention_mask)
         return {
             "input_ids": None,  # encoder_outputs is defined. input_ids not needed
             "encoder_outputs": encoder_outputs,
             "past_key_values": past,
             "decoder_input_ids": decoder_input_ids,
-            "attention_mask": attention_mask,
+            "attention_mask": self._generation_attention_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
         }
 
@@ -1895,7 +2253,9 @@ class BartForConditionalGeneration(PretrainedBartModel):
 
     def _force_token_ids_generation(self, scores, token_id) -> None:
         """force one of token_ids to be generated by setting prob of all other tokens to 0 (logprob=-float("inf"))"""
-        scores[:, [x for x in range(self.config.vocab_size) if x != token_id]] = -float("inf")
+        # two slice fills around token_id instead of indexing with a vocab_size long Python list
+        scores[:, :token_id] = -float("inf")
+        scores[:, token_id + 1 : self.config.vocab_size] = -float("inf")
 
     @staticmethod
     def _reorder_cache(past, beam_idx):
@@ -1921,7 +2281,7 @@ class BartForConditionalGeneration(PretrainedBartModel):
         return self.model.encode_action
 
     def get_output_embeddings(self):
-        return _make_linear_from_emb(self.model.shared)  # make it on the fly
+        return self.model.get_output_embeddings()
 
 
 @add_start_docstrings(
@@ -1984,9 +2344,16 @@ class BartForSequenceClassification(PretrainedBartModel):
         )
         x = outputs[0]  # last hidden state
         eos_mask = input_ids.eq(self.config.eos_token_id)
-        if len(torch.unique(eos_mask.sum(1))) > 1:
+        eos_counts = eos_mask.sum(1)
+        # compare against the first row, no sort as in unique; equal counts plus a first row with an <eos> means
+        # every row has one, so the common case still costs a single sync
+        if not bool(((eos_counts == eos_counts[0]) & eos_counts[0].gt(0)).all()):
+            if not bool(eos_counts.gt(0).all()):
+                raise ValueError("Every example must contain an <eos> token.")
             raise ValueError("All examples must have the same number of <eos> tokens.")
-        sentence_representation = x[eos_mask, :].view(x.size(0), -1, x.size(-1))[:, -1, :]
+        # the state at each row's last <eos>, picked directly rather than through a boolean gather of all of them
+        last_eos = (eos_mask.long() * torch.arange(eos_mask.size(1), device=eos_mask.device)).max(1).values
+        sentence_representation = x[torch.arange(x.size(0), device=x.device), last_eos]
         logits = self.classification_head(sentence_representation)
 
         loss = None
@@ -2133,11 +2500,10 @@ class SinusoidalPositionalEmbedding(nn.Embedding):
         The cos features are in the 2nd half of the vector. [dim // 2:]
         """
         n_pos, dim = out.shape
-        position_enc = np.array(
-            [[pos / np.power(10000, 2 * (j // 2) / dim) for j in range(dim)] for pos in range(n_pos)]
-        )
-        out[:, 0: dim // 2] = torch.FloatTensor(np.sin(position_enc[:, 0::2]))  # This line breaks for odd n_pos
-        out[:, dim // 2:] = torch.FloatTensor(np.cos(position_enc[:, 1::2]))
+        # column pairs 2i and 2i + 1 share the angle pos / 10000^(2i / dim), broadcast as (n_pos, dim // 2)
+        position_enc = np.arange(n_pos)[:, None] / np.power(10000, 2 * np.arange(dim // 2)[None, :] / dim)
+        out[:, 0: dim // 2] = torch.FloatTensor(np.sin(position_enc))  # This line breaks for odd n_pos
+        out[:, dim // 2:] = torch.FloatTensor(np.cos(position_enc))
         out.detach_()
         out.requires_grad = False
         return out
@@ -2146,9 +2512,8 @@ class SinusoidalPositionalEmbedding(nn.Embedding):
     def forward(self, input_ids, use_cache=False):
         """Input is expected to be of size [bsz x seqlen]."""
         bsz, seq_len = input_ids.shape[:2]
+        # the table is built once in __init__ and positions are contiguous, so slice it instead of a lookup
         if use_cache:
-            positions = input_ids.data.new(1, 1).fill_(seq_len - 1)  # called before slicing
-        else:
-            # starts at 0, ends at 1-seq_len
-            positions = torch.arange(seq_len, dtype=torch.long, device=self.weight.device)
-        return super().forward(positions)
+            return self.weight[seq_len - 1].view(1, 1, -1)  # called before slicing
+        # starts at 0, ends at 1-seq_len
+        return self.weight[:seq_len]
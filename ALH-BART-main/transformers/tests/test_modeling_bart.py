@@ -20,7 +20,7 @@ import timeout_decorator  # noqa
 
 from transformers import is_torch_available
 from transformers.file_utils import cached_property
-from transformers.testing_utils import require_torch, slow, torch_device
+from transformers.testing_utils import require_torch, require_torch_and_cuda, slow, torch_device
 
 from .test_configuration_common import ConfigTester
 from .test_modeling_common import ModelTesterMixin, ids_tensor
@@ -43,8 +43,12 @@ if is_torch_available():
         pipeline,
     )
     from transformers.modeling_bart import (
+        GAT,
+        DecoderLayer,
+        GraphAttentionLayer,
         SinusoidalPositionalEmbedding,
         _prepare_bart_decoder_inputs,
+        fused_linear_cross_entropy,
         invert_mask,
         shift_tokens_right,
     )
@@ -626,3 +630,152 @@ class TestSinusoidalPositionalEmbeddings(unittest.TestCase):
                 torch.tensor(self.desired_weights, device=torch_device), no_cache_pad_zero[:3, :5], atol=1e-3
             )
         )
+
+
+def _graph_free_bart_config(**kwargs):
+    """Tiny BartConfig with the graph/sentence options that lightning_base sets on the config all switched off."""
+    graph_kwargs = dict(
+        discourse_graph=False,
+        relation=False,
+        discourse_attn_head=0,
+        attention_group=0,
+        action_graph=False,
+        action_encoder_attn_head=0,
+        only_embedding=False,
+        new_graph_encoder=False,
+        composit=False,
+        sent_encoder=False,
+        use_graph=False,
+        no_rezero=True,
+    )
+    graph_kwargs.update(kwargs)
+    return BartConfig(
+        vocab_size=99,
+        d_model=24,
+        encoder_layers=2,
+        decoder_layers=2,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        decoder_ffn_dim=32,
+        max_position_embeddings=48,
+        eos_token_id=2,
+        pad_token_id=1,
+        bos_token_id=0,
+        **graph_kwargs,
+    )
+
+
+@require_torch
+class BartDecodingBufferTests(unittest.TestCase):
+    def test_fc1_scratch_only_on_cached_steps(self):
+        layer = DecoderLayer(_graph_free_bart_config()).to(torch_device).eval()
+        encoder_hidden_states = torch.randn(4, 2, 24, device=torch_device)
+        with torch.no_grad():
+            layer(torch.randn(3, 2, 24, device=torch_device), encoder_hidden_states)
+        self.assertIsNone(layer._scratch_fc1)
+
+        inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+        with inference_mode():
+            layer(torch.randn(1, 2, 24, device=torch_device), encoder_hidden_states, layer_state={})
+        self.assertIsNotNone(layer._scratch_fc1)
+        # the buffer made under inference_mode is written again under plain no_grad
+        with torch.no_grad():
+            layer(torch.randn(1, 2, 24, device=torch_device), encoder_hidden_states, layer_state={})
+
+    def test_cached_generate_matches_uncached(self):
+        torch.manual_seed(0)
+        model = BartForConditionalGeneration(_graph_free_bart_config()).to(torch_device).eval()
+        input_ids = torch.tensor([[71, 82, 18, 33, 2], [68, 34, 26, 2, 1]], device=torch_device)
+        for num_beams in (1, 2):
+            cached = model.generate(input_ids, num_beams=num_beams, max_length=8, use_cache=True)
+            uncached = model.generate(input_ids, num_beams=num_beams, max_length=8, use_cache=False)
+            self.assertListEqual(cached.tolist(), uncached.tolist())
+        # the logits and fc1 buffers do not outlive generate
+        self.assertIsNone(model._scratch_logits)
+        self.assertTrue(all(layer._scratch_fc1 is None for layer in model.model.decoder.layers))
+
+
+@require_torch
+class FusedLinearCrossEntropyTest(unittest.TestCase):
+    def test_matches_full_logits_cross_entropy(self):
+        torch.manual_seed(0)
+        vocab_size, d_model = 37, 8
+        labels = torch.randint(vocab_size, (3, 11), device=torch_device)
+        labels[0, 7:] = -100
+        labels[2, 4:] = -100
+        for chunk_size in (None, 5, 64):
+            inputs = [
+                torch.randn(3, 11, d_model, device=torch_device, requires_grad=True),
+                torch.randn(vocab_size, d_model, device=torch_device, requires_grad=True),
+                torch.randn(1, vocab_size, device=torch_device, requires_grad=True),
+            ]
+            hidden_states, weight, bias = inputs
+            logits = torch.nn.functional.linear(hidden_states, weight, bias.view(-1))
+            expected = torch.nn.functional.cross_entropy(logits.view(-1, vocab_size), labels.view(-1))
+            expected.backward()
+            expected_grads = [tensor.grad.clone() for tensor in inputs]
+            for tensor in inputs:
+                tensor.grad = None
+
+            # the fused loss checkpoints its chunks, which only supports .backward(), not autograd.grad
+            loss = fused_linear_cross_entropy(hidden_states, weight, bias, labels, chunk_size=chunk_size)
+            loss.backward()
+            self.assertTrue(torch.allclose(loss, expected, atol=1e-5))
+            for tensor, expected_grad in zip(inputs, expected_grads):
+                self.assertTrue(torch.allclose(tensor.grad, expected_grad, atol=1e-5))
+
+
+def _concat_graph_attention(layer, h, adj):
+    """``GraphAttentionLayer`` as scored before the split: ``[Wh_i || Wh_j || one_hot_embedding(adj_ij)] @ a``."""
+    Wh = torch.matmul(h, layer.W)
+    N = Wh.size(1)
+    a_input = torch.cat(
+        [Wh.unsqueeze(2).expand(-1, -1, N, -1), Wh.unsqueeze(1).expand(-1, N, -1, -1)], dim=-1
+    )  # B, N, N, 2 * out_features
+    if layer.relation:
+        a_input = torch.cat([a_input, layer.one_hot_embedding(adj.long())], dim=-1)
+    e = layer.leakyrelu(torch.matmul(a_input, layer.a).squeeze(3))
+    attention = torch.where(adj > 0, e, -9e15 * torch.ones_like(e))
+    h_prime = layer.layer_norm(torch.matmul(torch.softmax(attention, dim=2), Wh))
+    return torch.nn.functional.gelu(h_prime) if layer.concat else h_prime
+
+
+@require_torch
+class GraphAttentionTest(unittest.TestCase):
+    def test_relation_scores_match_concat_formulation(self):
+        torch.manual_seed(0)
+        layer = GraphAttentionLayer(8, 6, dropout=0.0, alpha=0.2, relation=True).to(torch_device).eval()
+        state_dict = layer.state_dict()
+        # trained checkpoints hold a random table here, _init_weights re-initializes every nn.Embedding
+        state_dict["one_hot_embedding.weight"] = torch.randn(18, 18)
+        layer.load_state_dict(state_dict)
+        h = torch.randn(2, 5, 8, device=torch_device)
+        adj = torch.randint(18, (2, 5, 5), device=torch_device).float()
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(layer(h, adj), _concat_graph_attention(layer, h, adj), atol=1e-5))
+
+    def test_batched_heads_match_per_head_layers(self):
+        torch.manual_seed(0)
+        gat = GAT(_graph_free_bart_config(relation=True), 8, 6, nheads=3).to(torch_device).eval()
+        for att in gat.attentions:
+            att.one_hot_embedding.weight.data.normal_()
+        h = torch.randn(2, 5, 8, device=torch_device)
+        adj = torch.randint(18, (2, 5, 5), device=torch_device).float()
+        with torch.no_grad():
+            batched = gat._heads_forward(h, adj <= 0, adj.long())
+            per_head = torch.cat([_concat_graph_attention(att, h, adj) for att in gat.attentions], dim=-1)
+        self.assertTrue(torch.allclose(batched, per_head, atol=1e-5))
+
+    @require_torch_and_cuda
+    def test_half_precision_scores(self):
+        torch.manual_seed(0)
+        gat = GAT(_graph_free_bart_config(relation=True), 8, 6, nheads=2).to(torch_device).eval().half()
+        h = torch.randn(2, 5, 8, device=torch_device).half()
+        adj = torch.randint(18, (2, 5, 5), device=torch_device).half()
+        adj[0, 2] = 0  # a node without neighbours
+        with torch.no_grad():
+            attention_out = gat.attentions[0](h, adj)
+            heads_out = gat._heads_forward(h, adj <= 0, adj.long())
+        self.assertFalse(torch.isnan(attention_out).any())
+        self.assertFalse(torch.isnan(heads_out).any())